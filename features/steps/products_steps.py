@@ -10,13 +10,10 @@ from compare import expect
 @given("the following products")
 def step_impl(context):
     """Load the database with new products"""
-    # List all of the products and delete them one by one
+    # Delete all of the products with a single request
     rest_endpoint = f"{context.BASE_URL}/api/products"
-    context.resp = requests.get(rest_endpoint)
-    #expect(context.resp.status_code).to_equal(200)
-    for product in context.resp.json():
-        context.resp = requests.delete(f"{rest_endpoint}/{product['id']}")
-        expect(context.resp.status_code).to_equal(204)
+    context.resp = requests.delete(rest_endpoint, params={"all": "true"})
+    expect(context.resp.status_code).to_equal(200)
     for row in context.table:
         payload = {
             "name": row["name"],
@@ -0,0 +1,13 @@
+"""
+Gunicorn Configuration
+
+Read by gunicorn from the working directory, on top of the command line.
+"""
+
+
+def worker_exit(server, worker):  # pylint: disable=unused-argument
+    """Writes the ratings still buffered by a worker before it exits"""
+    from service import routes  # pylint: disable=import-outside-toplevel
+
+    if routes.rating_buffer is not None:
+        routes.rating_buffer.stop()
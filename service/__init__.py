@@ -12,7 +12,7 @@ import sys
 from flask import Flask
 from flask_restx import Api
 from service import config
-from service.utils import log_handlers
+from service.utils import log_handlers, compression, encoders
 
 # Create Flask application
 app = Flask(__name__)
@@ -34,6 +34,8 @@ api = Api(
     #   authorizations=authorizations,
     prefix="/api",
 )
+# Encode the responses without going through the json module
+api.representation("application/json")(encoders.output_json)
 
 # Dependencies require we import the routes AFTER the Flask app is created
 # pylint: disable=wrong-import-position, wrong-import-order
@@ -45,6 +47,9 @@ from service.utils import error_handlers, cli_commands  # noqa: F401 E402
 # Set up logging for production
 log_handlers.init_logging(app, "gunicorn.error")
 
+# Compress the responses, and the static assets once and for all
+compression.init_compression(app)
+
 app.logger.info(70 * "*")
 app.logger.info("  S E R V I C E   R U N N I N G  ".center(70, "*"))
 app.logger.info(70 * "*")
@@ -20,6 +20,53 @@ SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 SQLALCHEMY_POOL_SIZE = 2
 
+# Keyset pagination of the product collection, only used when a limit or a
+# cursor is given: a plain GET /api/products still lists every Product.
+# CURSOR_PAGE_SIZE is the page size of a cursor sent without a limit.
+CURSOR_PAGE_SIZE = int(os.getenv("CURSOR_PAGE_SIZE", "100"))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "1000"))
+
+# Rows fetched per round trip from the server-side cursor when streaming
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "500"))
+
+# How the JSON listings are built: "python" serializes the rows read from
+# the database, "postgres" has PostgreSQL aggregate them into the JSON array
+LIST_RENDERER = os.getenv("LIST_RENDERER", "python")
+
+# Upper bound of the Products sent to a single bulk request
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "10000"))
+
+# Records of an imported feed validated and copied to PostgreSQL at a time
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "10000"))
+
+# Upper bound of the name suggestions returned per request
+MAX_SUGGESTIONS = int(os.getenv("MAX_SUGGESTIONS", "50"))
+
+# Number of equal width price buckets between MIN_PRICE and MAX_PRICE
+FACET_PRICE_BUCKETS = int(os.getenv("FACET_PRICE_BUCKETS", "9"))
+
+# Read-through cache of single Products, per worker process. The TTL bounds
+# how long an update made through another worker can be served stale.
+PRODUCT_CACHE_SIZE = int(os.getenv("PRODUCT_CACHE_SIZE", "1024"))
+PRODUCT_CACHE_TTL = float(os.getenv("PRODUCT_CACHE_TTL", "30"))
+
+# Cache of the listings, per worker process. Its capacity is a number of
+# Products summed over the cached listings, the largest are evicted first.
+QUERY_CACHE_CAPACITY = int(os.getenv("QUERY_CACHE_CAPACITY", "50000"))
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", "30"))
+
+# Responses of at least COMPRESSION_MIN_SIZE bytes are compressed with the
+# best encoding the client accepts, at this gzip level (1 to 9)
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "500"))
+COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", "6"))
+
+# Buffered ratings are acknowledged with 202 and written by a background
+# thread every RATING_FLUSH_INTERVAL seconds, or once RATING_BUFFER_MAX_SIZE
+# votes are pending. A worker that is killed loses the votes it buffered.
+RATING_BUFFER_ENABLED = os.getenv("RATING_BUFFER_ENABLED", "false").lower() == "true"
+RATING_FLUSH_INTERVAL = float(os.getenv("RATING_FLUSH_INTERVAL", "1"))
+RATING_BUFFER_MAX_SIZE = int(os.getenv("RATING_BUFFER_MAX_SIZE", "10000"))
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "sup3r-s3cr3t")
 LOGGING_LEVEL = logging.INFO
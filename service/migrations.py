@@ -0,0 +1,358 @@
+"""
+Schema Migrations for Product
+
+The database schema is built by applying an ordered list of versioned
+migrations instead of db.create_all(), so that deployments which already
+have the product table pick up new columns and indexes on startup.
+
+Every applied version is recorded in the schema_migrations table. Index
+migrations run outside of a transaction with CREATE INDEX CONCURRENTLY so
+that PostgreSQL keeps serving reads and writes while the index is built.
+"""
+import logging
+import time
+from collections import namedtuple
+from sqlalchemy import (
+    Boolean,
+    Column,
+    Float,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    inspect,
+    text,
+)
+from sqlalchemy.exc import DBAPIError
+
+logger = logging.getLogger("flask.app")
+
+# Key of the advisory lock taken so that only one worker migrates at a time
+LOCK_KEY = 7213
+
+# Seconds between two attempts of a waiting worker to take the lock
+LOCK_POLL_INTERVAL = 0.5
+
+# Rows updated per statement when filling a new column of existing rows
+BACKFILL_BATCH_SIZE = 1000
+
+# Weighted document of the full-text search, names rank above descriptions
+SEARCH_VECTOR = (
+    "setweight(to_tsvector('english', coalesce({row}name, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce({row}description, '')), 'B')"
+)
+
+Migration = namedtuple("Migration", ["version", "description", "upgrade", "concurrent"])
+
+
+######################################################################
+#  M I G R A T I O N   H E L P E R S
+######################################################################
+def create_index(
+    connection, name: str, columns: str, where: str = None, using: str = None
+):
+    """Creates an index on the product table if it does not exist yet
+
+    On PostgreSQL the index is built concurrently, so the connection must be
+    in autocommit mode. An index left INVALID by an interrupted concurrent
+    build is dropped and built again.
+    """
+    postgres = connection.dialect.name == "postgresql"
+    if postgres:
+        invalid = connection.execute(
+            text(
+                "SELECT 1 FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid "
+                "WHERE c.relname = :name AND NOT i.indisvalid"
+            ),
+            {"name": name},
+        ).first()
+        if invalid:
+            logger.warning("Rebuilding invalid index %s", name)
+            connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+    else:
+        # NULLS LAST is the default for these indexes on PostgreSQL only
+        columns = columns.replace(" NULLS LAST", "")
+    statement = "CREATE INDEX {}IF NOT EXISTS {} ON product {}({})".format(
+        "CONCURRENTLY " if postgres else "",
+        name,
+        f"USING {using} " if using else "",
+        columns,
+    )
+    if where:
+        statement += f" WHERE {where}"
+    logger.info("Creating index %s", name)
+    connection.execute(text(statement))
+
+
+def add_column(connection, name: str, definition: str):
+    """Adds a column to the product table if it does not exist yet"""
+    columns = [column["name"] for column in inspect(connection).get_columns("product")]
+    if name not in columns:
+        logger.info("Adding column %s", name)
+        connection.execute(text(f"ALTER TABLE product ADD COLUMN {name} {definition}"))
+
+
+######################################################################
+#  M I G R A T I O N S
+######################################################################
+def create_product_table(connection):
+    """Creates the product table as it was first defined"""
+    metadata = MetaData()
+    Table(
+        "product",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("name", String(63), nullable=True, unique=True),
+        Column(
+            "description", String(63), nullable=False, server_default="unavailable"
+        ),
+        Column("category", String(63), nullable=True),
+        Column("price", Float(), nullable=False),
+        Column("available", Boolean(), nullable=False),
+        Column("rating", Float, nullable=True),
+        Column("no_of_users_rated", Integer, nullable=False),
+    )
+    metadata.create_all(connection, checkfirst=True)
+
+
+def create_sort_indexes(connection):
+    """Creates the indexes that serve the sorted listings
+
+    Their leading columns also serve the price, rating and category filters.
+    """
+    create_index(connection, "ix_product_price_id", "price, id")
+    create_index(connection, "ix_product_rating_id", "rating DESC NULLS LAST, id")
+    create_index(connection, "ix_product_category_price_id", "category, price, id")
+    create_index(
+        connection,
+        "ix_product_category_rating_id",
+        "category, rating DESC NULLS LAST, id",
+    )
+
+
+def create_reverse_sort_indexes(connection):
+    """Creates the indexes that serve the sorts the first ones cannot
+
+    The id that breaks ties always ascends, so a descending price cannot be
+    read backwards from ix_product_price_id, and an ascending rating, with
+    its NULLs last, cannot be read backwards from ix_product_rating_id.
+    """
+    create_index(connection, "ix_product_price_desc_id", "price DESC, id")
+    create_index(connection, "ix_product_rating_asc_id", "rating NULLS LAST, id")
+
+
+def create_available_index(connection):
+    """Creates a partial index holding only the available products"""
+    create_index(connection, "ix_product_available_id", "id", where="available")
+
+
+def add_search_vector(connection):
+    """Adds the full-text search column, kept current by a trigger
+
+    The column is added empty, which is instant, and filled by the next
+    migration in small batches instead of rewriting the table under lock.
+    """
+    if connection.dialect.name != "postgresql":
+        return
+    add_column(connection, "search_vector", "tsvector")
+    connection.execute(
+        text(
+            f"""
+            CREATE OR REPLACE FUNCTION product_search_vector_update() RETURNS trigger AS $$
+            BEGIN
+                NEW.search_vector := {SEARCH_VECTOR.format(row="NEW.")};
+                RETURN NEW;
+            END
+            $$ LANGUAGE plpgsql
+            """
+        )
+    )
+    connection.execute(
+        text("DROP TRIGGER IF EXISTS product_search_vector_trigger ON product")
+    )
+    connection.execute(
+        text(
+            "CREATE TRIGGER product_search_vector_trigger "
+            "BEFORE INSERT OR UPDATE OF name, description ON product "
+            "FOR EACH ROW EXECUTE PROCEDURE product_search_vector_update()"
+        )
+    )
+
+
+def index_search_vector(connection):
+    """Fills the full-text search column of existing rows and indexes it"""
+    if connection.dialect.name != "postgresql":
+        return
+    backfill = text(
+        f"UPDATE product SET search_vector = {SEARCH_VECTOR.format(row='')} "
+        "WHERE id IN (SELECT id FROM product WHERE search_vector IS NULL "
+        "LIMIT :batch_size)"
+    )
+    while connection.execute(backfill, {"batch_size": BACKFILL_BATCH_SIZE}).rowcount:
+        pass
+    create_index(connection, "ix_product_search_vector", "search_vector", using="GIN")
+
+
+def index_names(connection):
+    """Indexes the names for prefix and typo-tolerant lookups
+
+    The trigram index needs the pg_trgm extension. When it cannot be
+    installed the service falls back to an in-process trigram index.
+    """
+    if connection.dialect.name != "postgresql":
+        return
+    create_index(connection, "ix_product_name_pattern", "name varchar_pattern_ops")
+    try:
+        connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    except DBAPIError as error:
+        logger.warning("Cannot install pg_trgm, names are not indexed: %s", error)
+        return
+    create_index(connection, "ix_product_name_trgm", "name gin_trgm_ops", using="GIN")
+
+
+def add_row_version(connection):
+    """Adds the version of every row, bumped by each update
+
+    A column with a constant default is added without rewriting the table.
+    """
+    add_column(connection, "version", "INTEGER NOT NULL DEFAULT 1")
+
+
+def add_rating_sum(connection):
+    """Adds the sum of the ratings, from which the average is derived
+
+    The column is added empty and filled by the next migration. On
+    PostgreSQL only the rows inserted from now on get the default, the
+    existing ones stay NULL until they are filled. SQLite cannot change the
+    default of a column, and Product.rate() copes with a NULL sum anyway.
+    """
+    add_column(connection, "rating_sum", "FLOAT")
+    if connection.dialect.name == "postgresql":
+        connection.execute(
+            text("ALTER TABLE product ALTER COLUMN rating_sum SET DEFAULT 0")
+        )
+
+
+def fill_rating_sum(connection):
+    """Fills the sum of the ratings of existing rows in small batches"""
+    backfill = text(
+        "UPDATE product SET rating_sum = coalesce(rating * no_of_users_rated, 0) "
+        "WHERE id IN (SELECT id FROM product WHERE rating_sum IS NULL "
+        "LIMIT :batch_size)"
+    )
+    while connection.execute(backfill, {"batch_size": BACKFILL_BATCH_SIZE}).rowcount:
+        pass
+
+
+def has_extension(engine, name: str) -> bool:
+    """Returns True if a PostgreSQL extension is installed in the database"""
+    if engine.dialect.name != "postgresql":
+        return False
+    with engine.connect() as connection:
+        row = connection.execute(
+            text("SELECT 1 FROM pg_extension WHERE extname = :name"), {"name": name}
+        ).first()
+    return row is not None
+
+
+MIGRATIONS = [
+    Migration(1, "Create the product table", create_product_table, False),
+    Migration(2, "Index the sort keys", create_sort_indexes, True),
+    Migration(3, "Index the available products", create_available_index, True),
+    Migration(4, "Add the full-text search column", add_search_vector, False),
+    Migration(5, "Index the full-text search column", index_search_vector, True),
+    Migration(6, "Index the names for lookups", index_names, True),
+    Migration(7, "Add the row version", add_row_version, False),
+    Migration(8, "Add the rating sum", add_rating_sum, False),
+    Migration(9, "Fill the rating sums", fill_rating_sum, True),
+    Migration(10, "Index the reverse sort keys", create_reverse_sort_indexes, True),
+]
+
+
+######################################################################
+#  M I G R A T I O N   R U N N E R
+######################################################################
+def _create_version_table(connection):
+    """Creates the table recording the applied migrations"""
+    connection.execute(
+        text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version INTEGER PRIMARY KEY, "
+            "description VARCHAR(255) NOT NULL, "
+            "applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)"
+        )
+    )
+
+
+def applied_versions(engine) -> set:
+    """Returns the versions of the migrations applied to a database"""
+    with engine.begin() as connection:
+        _create_version_table(connection)
+        rows = connection.execute(text("SELECT version FROM schema_migrations"))
+        return {row.version for row in rows}
+
+
+def _apply(engine, migration):
+    """Applies a single migration and records its version"""
+    logger.info("Applying migration %d: %s", migration.version, migration.description)
+    if migration.concurrent:
+        with engine.connect() as connection:
+            connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+            migration.upgrade(connection)
+    with engine.begin() as connection:
+        if not migration.concurrent:
+            migration.upgrade(connection)
+        connection.execute(
+            text(
+                "INSERT INTO schema_migrations (version, description) "
+                "VALUES (:version, :description)"
+            ),
+            {"version": migration.version, "description": migration.description},
+        )
+
+
+def _lock(connection):
+    """Takes the migration lock, polling until the worker holding it is done
+
+    A worker blocked in pg_advisory_lock() would be inside a statement, and
+    CREATE INDEX CONCURRENTLY run by the worker holding the lock waits for
+    every running transaction to end: both would wait for each other
+    forever, without PostgreSQL detecting a deadlock. Between two attempts
+    a waiting worker is idle, so the index builds can complete.
+    """
+    acquire = text("SELECT pg_try_advisory_lock(:key)")
+    while not connection.execute(acquire, {"key": LOCK_KEY}).scalar():
+        time.sleep(LOCK_POLL_INTERVAL)
+
+
+def upgrade(engine):
+    """Applies every migration that has not been applied to a database yet
+
+    Args:
+        engine: the SQLAlchemy engine of the database to migrate
+
+    Returns:
+        list: the versions that were applied
+    """
+    postgres = engine.dialect.name == "postgresql"
+    with engine.connect() as lock:
+        # autocommit so that this session never blocks the concurrent builds
+        lock = lock.execution_options(isolation_level="AUTOCOMMIT")
+        if postgres:
+            # serialize the workers that start at the same time
+            _lock(lock)
+        try:
+            done = applied_versions(engine)
+            pending = [m for m in MIGRATIONS if m.version not in done]
+            for migration in pending:
+                _apply(engine, migration)
+        finally:
+            if postgres:
+                lock.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": LOCK_KEY})
+    return [migration.version for migration in pending]
+
+
+def drop_version_table(engine):
+    """Forgets every applied migration, used when the tables are dropped"""
+    with engine.begin() as connection:
+        connection.execute(text("DROP TABLE IF EXISTS schema_migrations"))
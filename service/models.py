@@ -4,11 +4,38 @@ Models for Product
 All of the models are stored in this module
 """
 # from email.policy import default
+import csv
+import io
 import logging
+import operator
 
 # from wsgiref import validate
-from flask import Flask
+from flask import Flask, abort
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import (
+    and_,
+    case,
+    column,
+    or_,
+    func,
+    inspect,
+    literal_column,
+    select,
+    text,
+    true,
+    tuple_,
+    values,
+)
+from sqlalchemy.dialects.postgresql import (
+    TSVECTOR,
+    aggregate_order_by,
+    insert,
+)
+from sqlalchemy.orm import make_transient_to_detached
+from service import migrations
+from service.utils.cache import LRUCache, SizedCache
+from service.utils.streaming import batches
+from service.utils.trigram import TrigramIndex
 
 # from tomlkit import boolean
 # from sqlalchemy import null
@@ -20,12 +47,107 @@ MIN_RATE = 0
 MAX_RATE = 5
 MAX_DESCRIPTION_LENGTH = 63
 MAX_CATEGORY_LENGTH = 63
+MAX_NAME_LENGTH = 63
 logger = logging.getLogger("flask.app")
 
 # Create the SQLAlchemy object to be initialized later in init_db()
 db = SQLAlchemy()
 
 
+# Fields of a Product as exposed by the API
+PRODUCT_FIELDS = [
+    "id",
+    "name",
+    "description",
+    "category",
+    "price",
+    "available",
+    "rating",
+    "no_of_users_rated",
+]
+
+# Fields without which a Product cannot be created in bulk
+REQUIRED_FIELDS = ["name", "price", "available"]
+
+# Fields that can be set on every Product matching a filter at once
+BULK_UPDATE_FIELDS = ["category", "description", "price", "available"]
+
+# Rows inserted per statement by Product.create_many()
+BULK_INSERT_BATCH_SIZE = 1000
+
+# Records validated and copied to the staging table at a time on imports
+IMPORT_CHUNK_SIZE = 10000
+
+# Upper bound of the invalid records described in an import report
+MAX_IMPORT_ERRORS = 100
+
+# Fields a collection of Products can be sorted on
+SORT_FIELDS = ["id", "name", "category", "price", "rating"]
+
+# Rows are always ordered on a unique key so that pages are stable
+DEFAULT_ORDER = [("id", False)]
+
+# Full-text search results are ordered by relevance first
+SEARCH_ORDER = [("rank", True), ("id", False)]
+SEARCH_LANGUAGE = "english"
+
+# Filters comparing a column to a value, {argument: (column, comparison)}
+COLUMN_FILTERS = {
+    "name": ("name", operator.eq),
+    "category": ("category", operator.eq),
+    "price": ("price", operator.le),
+    "rating": ("rating", operator.ge),
+    "available": ("available", operator.eq),
+    "price_min": ("price", operator.ge),
+    "price_max": ("price", operator.le),
+    "rating_min": ("rating", operator.ge),
+    "rating_max": ("rating", operator.le),
+}
+
+
+def _same_as(column, value):
+    """Returns the clause matching rows whose column equals value (or NULL)"""
+    if value is None:
+        return column.is_(None)
+    return column == value
+
+
+def _after(column, value, descending: bool):
+    """Returns the clause matching rows that sort strictly after value
+
+    Follows the NULL placement of Product.order_by_clauses(), NULLs last in
+    both directions, so None is returned when nothing can sort after value.
+    """
+    if value is None:
+        return None
+    after = column < value if descending else column > value
+    if not getattr(column, "nullable", False):
+        return after
+    return or_(after, column.is_(None))
+
+
+def _escape_like(text: str) -> str:
+    """Escapes the LIKE wildcards of a text, using / as the escape character"""
+    return text.replace("/", "//").replace("%", "/%").replace("_", "/_")
+
+
+def _cache_key(product_id):
+    """Returns the key of a Product in Product.cache, None if not an id"""
+    try:
+        return int(product_id)
+    except (TypeError, ValueError):
+        return None
+
+
+def _load_names():
+    """Returns the (id, name) of every Product, for the in-process name index"""
+    return db.session.query(Product.id, Product.name).all()
+
+
+# Used by Product.suggest() when PostgreSQL has no pg_trgm extension
+name_index = TrigramIndex(_load_names)
+
+
 class DataValidationError(Exception):
     """Used for an data validation errors when deserializing"""
 
@@ -48,6 +170,20 @@ class Product(db.Model):
     available = db.Column(db.Boolean(), nullable=False, default=False)
     rating = db.Column(db.Float, nullable=True)
     no_of_users_rated = db.Column(db.Integer, nullable=False, default=0)
+    # sum of every rating, the rating is this sum over no_of_users_rated
+    rating_sum = db.Column(db.Float, nullable=True, default=0.0)
+    # bumped by every update, identifies the state of a row for ETags
+    version = db.Column(db.Integer, nullable=False, default=1)
+    # maintained by a trigger from name and description, never loaded
+    search_vector = db.deferred(db.Column(TSVECTOR, nullable=True))
+    # set by init_db() when the database can run trigram lookups itself
+    trigram_enabled = False
+    # read-through cache of find(), replaced by init_db() from the config
+    cache = LRUCache()
+    # cache of the listings, keyed on their normalized query and cost bounded
+    query_cache = SizedCache()
+    # bumped by every write of this worker, part of the query_cache keys
+    catalog_version = 0
 
     def __repr__(self):
         return "<Product %r id=[%s]>" % (self.name, self.id)
@@ -59,8 +195,10 @@ class Product(db.Model):
         try:
             logger.info("Creating %s", self.name)
             self.id = None  # id must be none to generate next primary key
+            self.rating_sum = (self.rating or 0.0) * (self.no_of_users_rated or 0)
             db.session.add(self)
             db.session.commit()
+            Product.catalog_changed([self.id])
         except Exception as error:
             db.session.rollback()
             # raise DataValidationError(error.args[0])
@@ -82,13 +220,23 @@ class Product(db.Model):
         logger.info("Saving %s", self.name)
         if not self.id:
             raise DataValidationError("Update called with empty ID field")
+        product_id = self.id
+        renamed = inspect(self).attrs.name.history.has_changes()
+        self.version = Product.version + 1
         db.session.commit()
+        Product.catalog_changed([product_id], names_changed=renamed)
 
     def delete(self):
         """Removes a product from the data store"""
         logger.info("Deleting %s", self.name)
+        product_id = self.id
         db.session.delete(self)
         db.session.commit()
+        Product.catalog_changed([product_id])
+
+    def cache_state(self) -> dict:
+        """Returns the column values to rebuild this Product from a cache"""
+        return {key: getattr(self, key) for key in PRODUCT_FIELDS + ["version"]}
 
     def serialize(self) -> dict:
         """Serializes a product into a dictionary"""
@@ -153,12 +301,20 @@ class Product(db.Model):
                 "Invalid Type for [no_of_users_rated]: " + str(type(no_of_users_rated))
             )
 
+    def check_rating_sum(self, data: dict):
+        """Keeps the sum of the ratings in step with a new rating or count"""
+        if "rating" in data or "no_of_users_rated" in data:
+            self.rating_sum = (self.rating or 0.0) * (self.no_of_users_rated or 0)
+
     def check_name(self, name):
         if not isinstance(name, str):
             raise TypeError
         elif name == "":
             raise DataValidationError(
               "name field cannot be empty ")
+        elif len(name) > MAX_NAME_LENGTH:
+            raise DataValidationError(
+                "Name length over limit.")
         else:
             self.name = name
 
@@ -205,6 +361,7 @@ class Product(db.Model):
                 self.check_rating(data["rating"])
             if "no_of_users_rated" in data:
                 self.check_no_of_users_rated(data["no_of_users_rated"])
+            self.check_rating_sum(data)
         except TypeError as error:
             raise DataValidationError(
                 "Invalid Product: body of request contained bad or no data - "
@@ -228,7 +385,414 @@ class Product(db.Model):
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
         app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
+        migrations.upgrade(db.engine)  # make our sqlalchemy tables and indexes
+        cls.trigram_enabled = migrations.has_extension(db.engine, "pg_trgm")
+        cls.cache = LRUCache(
+            app.config.get("PRODUCT_CACHE_SIZE", 1024),
+            app.config.get("PRODUCT_CACHE_TTL", 30.0),
+        )
+        cls.query_cache = SizedCache(
+            app.config.get("QUERY_CACHE_CAPACITY", 50000),
+            app.config.get("QUERY_CACHE_TTL", 30.0),
+        )
+        name_index.invalidate()
+
+    @classmethod
+    def catalog_changed(cls, product_ids: list = None, names_changed: bool = True):
+        """Invalidates what the caches hold after a write
+
+        Bumping catalog_version makes every cached listing unreachable at
+        once, while only the changed Products are dropped from Product.cache.
+        The name index is only rebuilt after writes that add, delete or
+        rename Products, as rebuilding it reads every name.
+
+        :param product_ids: the ids of the changed Products, None for any
+        :type product_ids: list
+        :param names_changed: whether the write changed the set of names
+        :type names_changed: bool
+
+        """
+        cls.catalog_version += 1
+        if product_ids is None:
+            cls.cache.clear()
+        else:
+            for product_id in product_ids:
+                cls.cache.delete(_cache_key(product_id))
+        if names_changed:
+            name_index.invalidate()
+
+    @classmethod
+    def bulk_row(cls, data) -> dict:
+        """Validates the data of a Product to create and returns its row
+
+        The same rules as deserialize() apply, and the same defaults as for
+        a single creation: no rating and no users rated.
+
+        :param data: the dictionary of the Product to create
+        :type data: dict
+
+        :return: the column values to insert
+        :rtype: dict
+
+        """
+        if not isinstance(data, dict):
+            raise DataValidationError("Invalid Product: not a JSON object")
+        missing = [field for field in REQUIRED_FIELDS if data.get(field) is None]
+        if missing:
+            raise DataValidationError("Invalid Product: missing " + ", ".join(missing))
+        data = dict(data)
+        if data.get("no_of_users_rated") is None:
+            data["no_of_users_rated"] = 0
+        product = cls(description="unavailable", rating=None).deserialize(data)
+        row = {field: getattr(product, field) for field in PRODUCT_FIELDS[1:]}
+        row["rating_sum"] = product.rating_sum
+        return row
+
+    @classmethod
+    def create_many(cls, items: list) -> list:
+        """Creates Products in bulk with multi-row INSERTs
+
+        Every valid item is inserted in a single transaction, with
+        BULK_INSERT_BATCH_SIZE rows per statement. Items that are invalid,
+        or whose name is taken, are reported instead of failing the others.
+
+        :param items: the dictionaries of the Products to create
+        :type items: list
+
+        :return: for every item in order, its (id, None) when created or
+            (None, error message) when not
+        :rtype: list
+
+        """
+        logger.info("Creating %d products in bulk", len(items))
+        results = [None] * len(items)
+        pending = {}
+        for index, data in enumerate(items):
+            try:
+                row = cls.bulk_row(data)
+            except DataValidationError as error:
+                results[index] = (None, str(error))
+                continue
+            if row["name"] in pending:
+                results[index] = (None, f"Error: name {row['name']} is repeated!")
+                continue
+            pending[row["name"]] = (index, row)
+
+        pending = list(pending.values())
+        table = cls.__table__
+        try:
+            for start in range(0, len(pending), BULK_INSERT_BATCH_SIZE):
+                batch = pending[start:start + BULK_INSERT_BATCH_SIZE]
+                statement = (
+                    insert(table)
+                    .values([row for _, row in batch])
+                    .on_conflict_do_nothing(index_elements=[table.c.name])
+                    .returning(table.c.id, table.c.name)
+                )
+                created = {row.name: row.id for row in db.session.execute(statement)}
+                for index, row in batch:
+                    if row["name"] in created:
+                        results[index] = (created[row["name"]], None)
+                    else:
+                        message = f"Error: name {row['name']} already exists!"
+                        results[index] = (None, message)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        cls.catalog_changed([])
+        return results
+
+    @classmethod
+    def update_many(
+        cls,
+        changes: dict,
+        price_factor: float = None,
+        dry_run: bool = False,
+        **filters,
+    ) -> int:
+        """Updates every Product matching the filters with a single UPDATE
+
+        The new values are validated like in deserialize(). A price factor
+        scales the current prices, which are kept within [MIN_PRICE,
+        MAX_PRICE] by the statement itself.
+
+        :param changes: the new values, taken from BULK_UPDATE_FIELDS
+        :type changes: dict
+        :param price_factor: what to multiply the prices by, if any
+        :type price_factor: float
+        :param dry_run: only count the Products that would be updated
+        :type dry_run: bool
+        :param filters: keyword filters accepted by filter_clauses()
+
+        :return: the number of Products updated, or matching on a dry run
+        :rtype: int
+
+        """
+        logger.info("Processing bulk update of %s with %s ...", filters, changes)
+        unknown = [field for field in changes if field not in BULK_UPDATE_FIELDS]
+        if unknown:
+            raise DataValidationError("Cannot update fields: " + ", ".join(unknown))
+        if price_factor is not None and "price" in changes:
+            raise DataValidationError("Cannot both set and scale the price")
+        if not changes and price_factor is None:
+            raise DataValidationError("No change to apply")
+        if price_factor is not None and (
+            isinstance(price_factor, bool)
+            or not isinstance(price_factor, (int, float))
+            or price_factor <= 0
+        ):
+            raise DataValidationError("Invalid price factor: " + str(price_factor))
+        checked = cls().deserialize(changes)
+        values = {getattr(cls, field): getattr(checked, field) for field in changes}
+        if price_factor is not None:
+            scaled = func.greatest(cls.price * price_factor, MIN_PRICE)
+            values[cls.price] = func.least(scaled, MAX_PRICE)
+        values[cls.version] = cls.version + 1
+
+        query = db.session.query(cls).filter(*cls.filter_clauses(**filters))
+        if dry_run:
+            return query.count()
+        try:
+            count = query.update(values, synchronize_session=False)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        # BULK_UPDATE_FIELDS never hold the name
+        cls.catalog_changed(names_changed=False)
+        logger.info("Updated %d products", count)
+        return count
+
+    @classmethod
+    def delete_many(cls, dry_run: bool = False, **filters) -> int:
+        """Deletes every Product matching the filters with a single DELETE
+
+        :param dry_run: only count the Products that would be deleted
+        :type dry_run: bool
+        :param filters: keyword filters accepted by filter_clauses()
+
+        :return: the number of Products deleted, or matching on a dry run
+        :rtype: int
+
+        """
+        logger.info("Processing bulk delete of %s ...", filters)
+        query = db.session.query(cls).filter(*cls.filter_clauses(**filters))
+        if dry_run:
+            return query.count()
+        try:
+            count = query.delete(synchronize_session=False)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        cls.catalog_changed(filters.get("ids"))
+        logger.info("Deleted %d products", count)
+        return count
+
+    @classmethod
+    def import_records(cls, records, chunk_size: int = IMPORT_CHUNK_SIZE) -> dict:
+        """Loads a feed of Products through COPY and merges it in the catalog
+
+        The records are validated like in create_many(), a chunk at a time,
+        and the valid ones are copied to a temporary staging table. A single
+        INSERT ... ON CONFLICT then merges the staging table into the
+        catalog: new names are inserted and known ones get the category,
+        description, price and availability of the feed, while their ratings
+        are kept. When a name appears more than once, its last record wins.
+        Everything happens in one transaction, so memory stays bounded by the
+        chunk size whatever the size of the feed.
+
+        :param records: an iterable of (line number, dictionary) pairs
+        :param chunk_size: the number of records validated and copied at once
+        :type chunk_size: int
+
+        :return: the numbers of Products inserted, updated and of invalid
+            records, with the errors of the first MAX_IMPORT_ERRORS of them
+        :rtype: dict
+
+        """
+        logger.info("Importing products")
+        columns = PRODUCT_FIELDS[1:]
+        report = {"inserted": 0, "updated": 0, "failed": 0, "errors": []}
+        connection = db.session.connection()
+        try:
+            connection.execute(
+                text(
+                    "CREATE TEMPORARY TABLE product_staging ("
+                    "line INTEGER, name VARCHAR(63), description VARCHAR(63), "
+                    "category VARCHAR(63), price FLOAT, available BOOLEAN, "
+                    "rating FLOAT, no_of_users_rated INTEGER) ON COMMIT DROP"
+                )
+            )
+            for chunk in batches(records, chunk_size):
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                for line, data in chunk:
+                    try:
+                        row = cls.bulk_row(data)
+                    except DataValidationError as error:
+                        report["failed"] += 1
+                        if len(report["errors"]) < MAX_IMPORT_ERRORS:
+                            report["errors"].append({"line": line, "error": str(error)})
+                        continue
+                    writer.writerow([line] + [row[column] for column in columns])
+                buffer.seek(0)
+                with connection.connection.cursor() as cursor:
+                    cursor.copy_expert(
+                        f"COPY product_staging (line, {', '.join(columns)}) "
+                        # empty cells are NULLs, except for a blank description
+                        "FROM STDIN WITH (FORMAT csv, FORCE_NOT_NULL (description))",
+                        buffer,
+                    )
+            merged = connection.execute(
+                text(
+                    f"""
+                    WITH merged AS (
+                        INSERT INTO product ({', '.join(columns)}, rating_sum)
+                        SELECT DISTINCT ON (name) {', '.join(columns)},
+                            coalesce(rating * no_of_users_rated, 0)
+                        FROM product_staging ORDER BY name, line DESC
+                        ON CONFLICT (name) DO UPDATE SET
+                            category = EXCLUDED.category,
+                            description = EXCLUDED.description,
+                            price = EXCLUDED.price,
+                            available = EXCLUDED.available,
+                            version = product.version + 1
+                        RETURNING xmax = 0 AS inserted
+                    )
+                    SELECT count(*) FILTER (WHERE inserted) AS inserted,
+                           count(*) FILTER (WHERE NOT inserted) AS updated
+                    FROM merged
+                    """
+                )
+            ).one()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        report.update(inserted=merged.inserted, updated=merged.updated)
+        # known names are kept, only inserted Products add names
+        cls.catalog_changed(names_changed=merged.inserted > 0)
+        logger.info("Imported %s", report)
+        return report
+
+    @classmethod
+    def rate(cls, product_id: int, rating: int):
+        """Adds a rating to a Product with a single atomic UPDATE
+
+        The rating is added to the sum of the ratings and the number of users
+        who rated, and the average is derived from both, all in the statement
+        itself. PostgreSQL applies concurrent ratings of a Product one after
+        the other on the latest row, so none is lost, and the row is only
+        locked for the time of the UPDATE instead of a read-modify-write.
+        The new values are the ones of rating_changes().
+
+        :param product_id: the id of the Product to rate
+        :type product_id: int
+        :param rating: the rating, from MIN_RATE to MAX_RATE
+        :type rating: int
+
+        :return: the serialized Product, or None if not found
+        :rtype: dict
+
+        """
+        logger.info("Rating product %s with %s ...", product_id, rating)
+        if (
+            isinstance(rating, bool)
+            or not isinstance(rating, (int, float))
+            or not MIN_RATE <= rating <= MAX_RATE
+        ):
+            raise DataValidationError("Invalid rating: " + str(rating))
+        statement = (
+            cls.__table__.update()
+            .where(cls.id == product_id)
+            .values(cls.rating_changes(float(rating), 1))
+            .returning(*cls.columns(PRODUCT_FIELDS))
+        )
+        try:
+            row = db.session.execute(statement).first()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        if row is None:
+            return None
+        cls.catalog_changed([row.id], names_changed=False)
+        return dict(row._mapping)
+
+    @classmethod
+    def rating_changes(cls, total, count) -> dict:
+        """Returns the SET values of an UPDATE adding ratings to a row
+
+        The new sum and number of ratings are computed from the row itself,
+        and the rating derived from them. A row without a rating holds no
+        rating yet, whatever its no_of_users_rated says, so it starts over
+        from the new ratings. Rows whose sum was not filled yet start from
+        rating * no_of_users_rated.
+
+        :param total: the sum of the new ratings, a value or a column
+        :param count: the number of new ratings, a value or a column
+
+        :return: the new values by column
+        :rtype: dict
+
+        """
+        unrated = cls.rating.is_(None)
+        rating_sum = case(
+            (unrated, total),
+            else_=func.coalesce(cls.rating_sum, cls.rating * cls.no_of_users_rated)
+            + total,
+        )
+        users = case((unrated, count), else_=cls.no_of_users_rated + count)
+        return {
+            cls.rating_sum: rating_sum,
+            cls.no_of_users_rated: users,
+            cls.rating: rating_sum / users,
+            cls.version: cls.version + 1,
+        }
+
+    @classmethod
+    def rate_many(cls, deltas: dict) -> list:
+        """Adds batches of ratings to Products with a single UPDATE
+
+        This is rate() for many Products at once: the sum and number of the
+        ratings of every Product are joined to the table as a VALUES list.
+        Products that no longer exist are skipped.
+
+        :param deltas: the (sum, number) of the new ratings by Product id
+        :type deltas: dict
+
+        :return: the ids of the Products rated
+        :rtype: list
+
+        """
+        if not deltas:
+            return []
+        logger.info("Rating %d products in bulk ...", len(deltas))
+        new = values(
+            column("id", db.Integer),
+            column("rating_sum", db.Float),
+            column("count", db.Integer),
+            name="new",
+        ).data(
+            # in id order, so that concurrent flushes lock rows alike
+            [(key, *deltas[key]) for key in sorted(deltas)]
+        )
+        statement = (
+            cls.__table__.update()
+            .where(cls.id == new.c.id)
+            .values(cls.rating_changes(new.c.rating_sum, new.c.count))
+            .returning(cls.id)
+        )
+        try:
+            rated = [row.id for row in db.session.execute(statement)]
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        cls.catalog_changed(rated, names_changed=False)
+        return rated
 
     @classmethod
     def all(cls):
@@ -237,18 +801,35 @@ class Product(db.Model):
         return cls.query.all()
 
     @classmethod
-    def find(cls, product_id: int):
+    def find(cls, product_id: int, cached: bool = True):
         """Find a Product by it's id
 
+        Products are read through Product.cache: a hit is attached to the
+        session without a database round trip, and update() and delete()
+        drop the cached copy. A copy cached by this worker can outlive a
+        delete made through another one, so a Product about to be written
+        must be found with cached=False.
+
         :param product_id: the id of the Product to find
         :type product_id: int
+        :param cached: whether a copy from Product.cache can be returned
+        :type cached: bool
 
-        :return: an instance with the product_id, or 404_NOT_FOUND if not found
+        :return: an instance with the product_id, or None if not found
         :rtype: Product
 
         """
         logger.info("Processing lookup for id %s ...", product_id)
-        return cls.query.get(product_id)
+        key = _cache_key(product_id)
+        state = cls.cache.get(key) if cached and key is not None else None
+        if state is not None:
+            product = cls(**state)
+            make_transient_to_detached(product)
+            return db.session.merge(product, load=False)
+        product = cls.query.get(product_id)
+        if product is not None and key is not None:
+            cls.cache.set(key, product.cache_state())
+        return product
 
     @classmethod
     def find_or_404(cls, product_id: int):
@@ -259,7 +840,10 @@ class Product(db.Model):
         :rtype: Product
         """
         logger.info("Processing lookup or 404 for id %s ...", product_id)
-        return cls.query.get_or_404(product_id)
+        product = cls.find(product_id)
+        if product is None:
+            abort(404)
+        return product
 
     @classmethod
     def find_by_name(cls, name: str) -> list:
@@ -312,6 +896,486 @@ class Product(db.Model):
         logger.info("Processing price query for %s ...", price)
         return cls.query.filter(cls.price <= price)
 
+    @classmethod
+    def filter_clauses(
+        cls,
+        q: str = None,
+        name_prefix: str = None,
+        name_like: str = None,
+        ids: list = None,
+        **filters,
+    ) -> list:
+        """Returns the WHERE clauses for a combination of Product filters
+
+        Any filter left as None is not applied, so an empty call matches every
+        Product. The clauses are meant to be passed together to a single
+        query's filter() so that the database evaluates them in one pass.
+
+        :param name: the exact name of the Products to match
+        :type name: str
+        :param category: the category of the Products to match
+        :type category: str
+        :param price: the highest price of the Products to match
+        :type price: float
+        :param rating: the lowest rating of the Products to match
+        :type rating: float
+        :param available: the availability of the Products to match
+        :type available: bool
+        :param price_min: the lowest price of the Products to match
+        :type price_min: float
+        :param price_max: the highest price of the Products to match
+        :type price_max: float
+        :param rating_min: the lowest rating of the Products to match
+        :type rating_min: float
+        :param rating_max: the highest rating of the Products to match
+        :type rating_max: float
+        :param q: a full-text search over the name and description
+        :type q: str
+        :param name_prefix: the start of the names to match, case sensitive
+        :type name_prefix: str
+        :param name_like: a part of the names to match, case insensitive
+        :type name_like: str
+        :param ids: the ids of the Products to match
+        :type ids: list
+
+        :return: a list of SQLAlchemy boolean expressions
+        :rtype: list
+
+        """
+        unknown = [argument for argument in filters if argument not in COLUMN_FILTERS]
+        if unknown:
+            raise TypeError("Unknown filters: " + ", ".join(unknown))
+        clauses = []
+        for argument, value in filters.items():
+            if value is not None:
+                column, compare = COLUMN_FILTERS[argument]
+                clauses.append(compare(getattr(cls, column), value))
+        clauses.extend(cls.text_clauses(q, name_prefix, name_like))
+        if ids is not None:
+            clauses.append(cls.ids_clause(ids))
+        return clauses
+
+    @classmethod
+    def text_clauses(
+        cls, q: str = None, name_prefix: str = None, name_like: str = None
+    ) -> list:
+        """Returns the WHERE clauses of the full-text search and name lookups
+
+        :param q: a full-text search over the name and description
+        :type q: str
+        :param name_prefix: the start of the names to match, case sensitive
+        :type name_prefix: str
+        :param name_like: a part of the names to match, case insensitive
+        :type name_like: str
+
+        :return: a list of SQLAlchemy boolean expressions
+        :rtype: list
+
+        """
+        clauses = []
+        if q is not None:
+            clauses.append(cls.search_vector.op("@@")(cls.search_query(q)))
+        if name_prefix is not None:
+            clauses.append(cls.name.startswith(name_prefix, autoescape=True))
+        if name_like is not None:
+            clauses.append(cls.name.ilike(f"%{_escape_like(name_like)}%", escape="/"))
+        return clauses
+
+    @classmethod
+    def ids_clause(cls, ids: list):
+        """Returns the WHERE clause matching the Products with some ids"""
+        # an expanding parameter, so the statement is cached whatever the
+        # number of ids, and compiles on every database
+        return cls.id.in_(list(ids))
+
+    @classmethod
+    def search_query(cls, q: str):
+        """Returns the tsquery of a full-text search written by a user"""
+        return func.websearch_to_tsquery(SEARCH_LANGUAGE, q)
+
+    @classmethod
+    def search_rank(cls, q: str):
+        """Returns the relevance of a Product for a full-text search
+
+        The rank is cast to double precision so that it round-trips exactly
+        through a pagination cursor.
+        """
+        return func.ts_rank(cls.search_vector, cls.search_query(q)).cast(db.Float)
+
+    @classmethod
+    def sort_expression(cls, key: str, q: str = None):
+        """Returns the column, or the search rank, that a sort key refers to"""
+        if key == "rank":
+            return cls.search_rank(q)
+        return cls.__table__.c[key]
+
+    @classmethod
+    def columns(cls, fields: list) -> list:
+        """Returns the table columns for a list of Product field names
+
+        :param fields: names taken from PRODUCT_FIELDS
+        :type fields: list
+
+        :return: the matching columns, to narrow the SELECT list of a query
+        :rtype: list
+
+        """
+        unknown = [field for field in fields if field not in PRODUCT_FIELDS]
+        if unknown:
+            raise DataValidationError("Invalid fields: " + ", ".join(unknown))
+        return [cls.__table__.c[field] for field in fields]
+
+    @classmethod
+    def find_fields(cls, product_id: int, fields: list):
+        """Find some of the fields of a Product by it's id
+
+        Only the requested columns are selected, and no Product instance is
+        built for them.
+
+        :param product_id: the id of the Product to find
+        :type product_id: int
+        :param fields: the names of the fields to load
+        :type fields: list
+
+        :return: a row with the requested fields and the version, or None if
+            not found
+        :rtype: Row
+
+        """
+        logger.info("Processing lookup of %s for id %s ...", fields, product_id)
+        return (
+            cls.query.with_entities(*cls.columns(fields), cls.version)
+            .filter(cls.id == product_id)
+            .first()
+        )
+
+    @classmethod
+    def order_by_clauses(cls, order: list, q: str = None) -> list:
+        """Returns the ORDER BY clauses for a list of (column, descending) keys
+
+        NULLs sort last in both directions, so that unrated Products come
+        after the best rated ones. NULLS LAST is only written for nullable
+        columns: on the others it would keep PostgreSQL from reading an index
+        backwards, as a descending scan puts NULLs first. The composite
+        indexes created in service/migrations.py use the same NULL placement
+        so that PostgreSQL can read them in order.
+        """
+        clauses = []
+        for key, descending in order:
+            column = cls.sort_expression(key, q)
+            clause = column.desc() if descending else column.asc()
+            if getattr(column, "nullable", False):
+                clause = clause.nullslast()
+            clauses.append(clause)
+        return clauses
+
+    @classmethod
+    def keyset_clause(cls, order: list, values: list, q: str = None):
+        """Returns the clause matching every row after `values` in `order`
+
+        This is the seek predicate used for keyset pagination: instead of
+        skipping rows with an OFFSET, the next page starts right after the
+        sort key values of the last row that was returned. The order must end
+        with a unique, non-null key (the id) so that every row has a distinct
+        position.
+
+        :param order: the (column, descending) keys the rows are sorted on
+        :type order: list
+        :param values: the sort key values of the last row already returned
+        :type values: list
+        :param q: the full-text search the rows are ranked by, if any
+        :type q: str
+
+        :return: a SQLAlchemy boolean expression
+        """
+        alternatives = []
+        for position, (key, descending) in enumerate(order):
+            ties = [
+                _same_as(cls.sort_expression(prev_key, q), value)
+                for (prev_key, _), value in zip(order[:position], values)
+            ]
+            after = _after(cls.sort_expression(key, q), values[position], descending)
+            if after is not None:
+                alternatives.append(and_(*ties, after))
+        return or_(*alternatives)
+
+    @classmethod
+    def listed_columns(cls, fields: list, order: list, q: str = None) -> list:
+        """Returns the columns of the requested fields followed by the sort keys
+
+        The sort keys that are not requested fields are labelled with their
+        name, since they are needed to build the cursor of the next page.
+        """
+        columns = cls.columns(fields)
+        for key, _ in order:
+            if key not in fields:
+                columns.append(cls.sort_expression(key, q).label(key))
+        return columns
+
+    @classmethod
+    def select_rows(
+        cls,
+        order: list = None,
+        after: list = None,
+        limit: int = None,
+        fields: list = None,
+        versions: bool = False,
+        **filters,
+    ):
+        """Returns the SELECT of the Products matching every given filter
+
+        It is a Core statement, so the rows it reads are plain tuples that are
+        neither built into Product instances nor tracked by the session.
+
+        :param order: the (column, descending) keys to sort on, by id if None
+        :type order: list
+        :param after: the sort key values of the last row of the previous page
+        :type after: list
+        :param limit: the maximum number of rows to return
+        :type limit: int
+        :param fields: the fields to select, every field if None
+        :type fields: list
+        :param versions: also select the row version, labelled row_version
+        :type versions: bool
+        :param filters: keyword filters accepted by filter_clauses()
+
+        :return: a statement selecting the fields, in order, then the sort keys
+        :rtype: Select
+
+        """
+        logger.info("Processing read-only query for %s ...", filters)
+        q = filters.get("q")
+        order = order or (SEARCH_ORDER if q is not None else DEFAULT_ORDER)
+        columns = cls.listed_columns(fields or PRODUCT_FIELDS, order, q)
+        if versions:
+            columns.append(cls.version.label("row_version"))
+        statement = select(*columns).where(*cls.filter_clauses(**filters))
+        if after is not None:
+            statement = statement.where(cls.keyset_clause(order, after, q))
+        statement = statement.order_by(*cls.order_by_clauses(order, q))
+        if limit is not None:
+            statement = statement.limit(limit)
+        return statement
+
+    @classmethod
+    def read_rows(cls, statement, batch_size: int = None):
+        """Runs a statement from select_rows() and returns its rows
+
+        :param statement: the statement to run
+        :type statement: Select
+        :param batch_size: when given, rows are fetched from a server-side
+            cursor this many at a time instead of all at once
+        :type batch_size: int
+
+        :return: an iterable of rows
+        :rtype: Result
+
+        """
+        if batch_size:
+            statement = statement.execution_options(yield_per=batch_size)
+        return db.session.execute(statement)
+
+    @classmethod
+    def export_rows(cls, batch_size: int):
+        """Returns every Product as a row of PRODUCT_FIELDS, in id order
+
+        :param batch_size: the number of rows fetched at a time from a named
+            server-side cursor, which bounds the memory used
+        :type batch_size: int
+
+        :return: an iterable of rows
+        :rtype: Result
+
+        """
+        logger.info("Exporting all products")
+        return cls.read_rows(cls.select_rows(), batch_size)
+
+    @classmethod
+    def render_json(
+        cls,
+        order: list = None,
+        after: list = None,
+        limit: int = None,
+        fields: list = None,
+        **filters,
+    ) -> tuple:
+        """Returns the matching Products as a JSON array built by PostgreSQL
+
+        The rows of select_rows() are turned into JSON objects and aggregated
+        in the database, so a single text value is read back instead of one
+        row per Product. The page holds at most `limit` Products, one more
+        row is read to find out if there is a next page. The ids and row
+        versions of the page are hashed in the same query, to tag it.
+
+        :param order: the (column, descending) keys to sort on, by id if None
+        :type order: list
+        :param after: the sort key values of the last row of the previous page
+        :type after: list
+        :param limit: the maximum number of Products to return
+        :type limit: int
+        :param fields: the fields to return, every field if None
+        :type fields: list
+        :param filters: keyword filters accepted by filter_clauses()
+
+        :return: the JSON text, the number of Products in it, the sort keys
+            of the last one when there is a next page, else None, and the md5
+            of the "id:row_version" of its Products joined by commas
+        :rtype: tuple
+
+        """
+        q = filters.get("q")
+        order = order or (SEARCH_ORDER if q is not None else DEFAULT_ORDER)
+        names = fields or PRODUCT_FIELDS
+        statement = cls.select_rows(
+            order=order,
+            after=after,
+            limit=None if limit is None else limit + 1,
+            fields=fields,
+            versions=True,
+            **filters,
+        )
+        position = func.row_number().over(order_by=cls.order_by_clauses(order, q))
+        rows = statement.add_columns(position.label("position")).subquery("listing")
+        product = func.json_build_object(
+            *[item for name in names for item in (name, rows.c[name])]
+        )
+        keys = func.json_build_object(
+            *[item for key, _ in order for item in (key, rows.c[key])]
+        )
+        in_page = rows.c.position <= limit if limit is not None else true()
+        versions = func.string_agg(
+            func.concat(rows.c.id, ":", rows.c.row_version),
+            aggregate_order_by(literal_column("','"), rows.c.position),
+        ).filter(in_page)
+        body = func.coalesce(
+            func.json_agg(aggregate_order_by(product, rows.c.position)).filter(in_page),
+            literal_column("'[]'::json"),
+        )
+        row = db.session.execute(
+            select(
+                body.cast(db.Text).label("body"),
+                func.count().label("count"),
+                func.json_agg(keys).filter(rows.c.position == limit).label("last"),
+                func.md5(func.coalesce(versions, "")).label("digest"),
+            )
+        ).one()
+        if limit is not None and row.count > limit:
+            return row.body, limit, row.last[0], row.digest
+        return row.body, row.count, None, row.digest
+
+    @classmethod
+    def facets(cls, price_buckets: int = 9, **filters) -> dict:
+        """Returns the facet counts of the Products matching some filters
+
+        Every count is computed by a single grouped query: one GROUPING SETS
+        pass over the matching rows counts them per category, per
+        availability, per rating bucket and per price bucket.
+
+        :param price_buckets: the number of equal width price buckets
+            between MIN_PRICE and MAX_PRICE
+        :type price_buckets: int
+        :param filters: keyword filters accepted by filter_clauses()
+
+        :return: the total, category, available, rating and price counts
+        :rtype: dict
+
+        """
+        logger.info("Processing facets query for %s ...", filters)
+        rating_bucket = func.least(func.floor(cls.rating), MAX_RATE - 1)
+        price_bucket = func.least(
+            func.greatest(
+                func.width_bucket(cls.price, MIN_PRICE, MAX_PRICE, price_buckets), 1
+            ),
+            price_buckets,
+        )
+        groups = [cls.category, cls.available, rating_bucket, price_bucket]
+        rows = (
+            db.session.query(
+                *[group.label(f"group_{i}") for i, group in enumerate(groups)],
+                func.grouping(*groups).label("grouping"),
+                func.count().label("count"),
+            )
+            .filter(*cls.filter_clauses(**filters))
+            .group_by(
+                func.grouping_sets(*[tuple_(group) for group in groups], tuple_())
+            )
+            .all()
+        )
+        # GROUPING() sets a bit for every column the row is NOT grouped by
+        everything = (1 << len(groups)) - 1
+        by_column = {
+            everything ^ (1 << (len(groups) - 1 - i)): i for i in range(len(groups))
+        }
+        width = (MAX_PRICE - MIN_PRICE) / price_buckets
+        facets = {
+            "total": 0,
+            "category": [],
+            "available": {"true": 0, "false": 0},
+            "rating": [
+                {"min": low, "max": low + 1, "count": 0}
+                for low in range(MIN_RATE, MAX_RATE)
+            ]
+            + [{"min": None, "max": None, "count": 0}],
+            "price": [
+                {
+                    "min": MIN_PRICE + i * width,
+                    "max": MIN_PRICE + (i + 1) * width,
+                    "count": 0,
+                }
+                for i in range(price_buckets)
+            ],
+        }
+        for row in rows:
+            if row.grouping == everything:
+                facets["total"] = row.count
+                continue
+            column = by_column[row.grouping]
+            value = row[column]
+            if column == 0:
+                facets["category"].append({"value": value, "count": row.count})
+            elif column == 1:
+                facets["available"]["true" if value else "false"] = row.count
+            elif column == 2:
+                index = -1 if value is None else int(value) - MIN_RATE
+                facets["rating"][index]["count"] = row.count
+            else:
+                facets["price"][int(value) - 1]["count"] = row.count
+        facets["category"].sort(
+            key=lambda facet: (-facet["count"], facet["value"] or "")
+        )
+        return facets
+
+    @classmethod
+    def suggest(cls, text: str, limit: int = 10) -> list:
+        """Returns the names closest to a partial or misspelled name
+
+        Names starting with the text come first, followed by the names that
+        are most alike according to trigram similarity. This uses the pg_trgm
+        index when the extension is installed, and an in-process trigram
+        index of the names otherwise.
+
+        :param text: what the user typed so far
+        :type text: str
+        :param limit: the maximum number of suggestions
+        :type limit: int
+
+        :return: a list of (id, name, score) tuples, best match first
+        :rtype: list
+
+        """
+        logger.info("Processing suggestions for %s ...", text)
+        if not cls.trigram_enabled:
+            return name_index.search(text, limit)
+        score = func.similarity(cls.name, text)
+        prefix = cls.name.ilike(f"{_escape_like(text)}%", escape="/")
+        rows = (
+            db.session.query(cls.id, cls.name, score.label("score"))
+            .filter(or_(cls.name.op("%")(text), prefix))
+            .order_by(score.desc(), cls.name)
+            .limit(limit)
+        )
+        return [(row.id, row.name, row.score) for row in rows]
+
     @classmethod
     def find_by_availability(cls) -> list:
         """Returns all the products that are currently available
@@ -3,14 +3,48 @@ My Service
 
 Describe what your service does here
 """
-from flask import request, abort
+import base64
+import binascii
+import hashlib
+import json
+from types import SimpleNamespace
+from urllib.parse import urlencode
+from flask import request, abort, stream_with_context
+from werkzeug.http import quote_etag
 from flask_restx import Resource, fields, reqparse, inputs
 from service.utils import status
-from service.models import Product
+from service.utils.ratings import init_rating_buffer
+from service.utils.feeds import (
+    EXPORT_FORMATS,
+    FEED_MEDIA_TYPES,
+    check_export_format,
+    export_chunks,
+    read_feed,
+)
+from service.utils.streaming import (
+    stream_response,
+    STREAM_MEDIA_TYPES,
+    JSON_MEDIA_TYPE,
+    NDJSON_MEDIA_TYPE,
+)
+from service.models import (
+    Product,
+    DEFAULT_ORDER,
+    PRODUCT_FIELDS,
+    SEARCH_ORDER,
+    SORT_FIELDS,
+    MIN_PRICE,
+    MAX_PRICE,
+    MIN_RATE,
+    MAX_RATE,
+)
 
 # Import Flask application
 from . import app, api
 
+# write-behind buffer of the ratings, set by init_db() when it is enabled
+rating_buffer = None
+
 
 ######################################################################
 # GET INDEX
@@ -57,30 +91,244 @@ product_model = api.inherit(
     },
 )
 
-# query string arguments
-product_args = reqparse.RequestParser()
-product_args.add_argument(
+batch_result_model = api.model(
+    "BatchResult",
+    {
+        "index": fields.Integer(description="The position of the item in the batch"),
+        "id": fields.Integer(description="The id of the created Product, if any"),
+        "error": fields.String(description="Why the item was not created, if not"),
+    },
+)
+
+batch_model = api.model(
+    "BatchReport",
+    {
+        "created": fields.Integer(description="The number of created Products"),
+        "failed": fields.Integer(description="The number of items not created"),
+        "results": fields.List(
+            fields.Nested(batch_result_model), description="One result per item"
+        ),
+    },
+)
+
+bulk_update_model = api.model(
+    "BulkUpdate",
+    {
+        "category": fields.String(description="The new category"),
+        "description": fields.String(description="The new description"),
+        "available": fields.Boolean(description="The new availability"),
+        "price": fields.Float(description="The new price"),
+        "price_factor": fields.Float(
+            description="What to multiply the prices by, e.g. 0.9 for a 10% discount"
+        ),
+    },
+)
+
+lookup_model = api.model(
+    "Lookup",
+    {
+        "ids": fields.List(
+            fields.Integer, required=True, description="The ids of the Products"
+        ),
+        "fields": fields.List(
+            fields.String, description="The fields to return, all of them if empty"
+        ),
+    },
+)
+
+lookup_result_model = api.model(
+    "LookupResult",
+    {
+        "products": fields.List(
+            fields.Nested(product_model), description="The Products found, in order"
+        ),
+        "missing": fields.List(fields.Integer, description="The ids not found"),
+    },
+)
+
+import_error_model = api.model(
+    "ImportError",
+    {
+        "line": fields.Integer(description="The line of the invalid record"),
+        "error": fields.String(description="Why the record is invalid"),
+    },
+)
+
+import_model = api.model(
+    "ImportReport",
+    {
+        "inserted": fields.Integer(description="The number of new Products"),
+        "updated": fields.Integer(description="The number of updated Products"),
+        "failed": fields.Integer(description="The number of invalid records"),
+        "errors": fields.List(
+            fields.Nested(import_error_model),
+            description="The first invalid records",
+        ),
+    },
+)
+
+bulk_result_model = api.model(
+    "BulkResult",
+    {
+        "count": fields.Integer(description="The number of Products affected"),
+        "dry_run": fields.Boolean(description="True if nothing was changed"),
+    },
+)
+
+# query string arguments that filter the Products
+filter_args = reqparse.RequestParser()
+filter_args.add_argument(
     "name", type=str, required=False, help="List Products by name"
 )
-product_args.add_argument(
+filter_args.add_argument(
     "category", type=str, required=False, help="List Products by category"
 )
-product_args.add_argument(
+filter_args.add_argument(
     "available",
     type=inputs.boolean,
     required=False,
     help="List Products by availability",
 )
-product_args.add_argument(
+filter_args.add_argument(
     "price", type=float, required=False, help="List Products by price"
 )
-product_args.add_argument(
+filter_args.add_argument(
     "rating", type=float, required=False, help="List Products by rating"
 )
+filter_args.add_argument(
+    "q",
+    type=str,
+    required=False,
+    help="Full-text search over the name and description, ranked by relevance",
+)
+filter_args.add_argument(
+    "name_prefix", type=str, required=False, help="List Products by name prefix"
+)
+filter_args.add_argument(
+    "name_like",
+    type=str,
+    required=False,
+    help="List Products whose name contains this text, ignoring case",
+)
+filter_args.add_argument(
+    "price_min", type=float, required=False, help="List Products from this price"
+)
+filter_args.add_argument(
+    "price_max", type=float, required=False, help="List Products up to this price"
+)
+filter_args.add_argument(
+    "rating_min", type=float, required=False, help="List Products from this rating"
+)
+filter_args.add_argument(
+    "rating_max", type=float, required=False, help="List Products up to this rating"
+)
 
+# query string arguments of a listing: the filters, paging and formatting
+product_args = filter_args.copy()
 product_args.add_argument(
     "no_of_users_rated", type=int, required=False, help="No of users rated"
 )
+product_args.add_argument(
+    "limit", type=int, required=False, help="Maximum number of Products per page"
+)
+product_args.add_argument(
+    "cursor", type=str, required=False, help="Opaque cursor of the page to return"
+)
+product_args.add_argument(
+    "sort",
+    type=str,
+    required=False,
+    help="Comma separated sort keys, prefixed with - for descending order",
+)
+product_args.add_argument(
+    "fields",
+    type=str,
+    required=False,
+    help="Comma separated list of the fields to return",
+)
+product_args.add_argument(
+    "ids",
+    type=str,
+    required=False,
+    help="Comma separated ids of the Products to return, in this order",
+)
+product_args.add_argument(
+    "stream",
+    type=inputs.boolean,
+    required=False,
+    help="Stream the Products as a chunked response",
+)
+
+# query string arguments selecting the Products changed by a bulk operation,
+# never read from the body which holds the changes themselves
+bulk_args = filter_args.copy()
+for argument in bulk_args.args:
+    argument.location = "args"
+bulk_args.add_argument(
+    "ids",
+    type=str,
+    required=False,
+    location="args",
+    help="Comma separated ids of the Products to change",
+)
+bulk_args.add_argument(
+    "all",
+    type=inputs.boolean,
+    required=False,
+    location="args",
+    help="Must be true to change every Product when no filter is given",
+)
+bulk_args.add_argument(
+    "dry_run",
+    type=inputs.boolean,
+    required=False,
+    location="args",
+    help="Only count the Products that would be changed",
+)
+
+# query string arguments of a catalog export
+export_args = reqparse.RequestParser()
+export_args.add_argument(
+    "format",
+    type=str,
+    choices=list(EXPORT_FORMATS),
+    default="ndjson",
+    location="args",
+    help="The format of the export",
+)
+
+# query string arguments of a single Product
+fields_args = reqparse.RequestParser()
+fields_args.add_argument(
+    "fields",
+    type=str,
+    required=False,
+    location="args",
+    help="Comma separated list of the fields to return",
+)
+
+# query string arguments of name suggestions
+suggest_args = reqparse.RequestParser()
+suggest_args.add_argument(
+    "q", type=str, required=True, location="args", help="The name typed so far"
+)
+suggest_args.add_argument(
+    "limit",
+    type=int,
+    required=False,
+    default=10,
+    location="args",
+    help="Maximum number of suggestions",
+)
+
+suggestion_model = api.model(
+    "Suggestion",
+    {
+        "id": fields.Integer(description="The id of the suggested Product"),
+        "name": fields.String(description="The suggested name"),
+        "score": fields.Float(description="How alike the name is, from 0 to 1"),
+    },
+)
 
 
 ######################################################################
@@ -102,25 +350,39 @@ class ProductResource(Resource):
     # RETRIEVE A PRODUCT
     # ------------------------------------------------------------------
     @api.doc("get_products")
+    @api.expect(fields_args)
+    @api.response(200, "Success", product_model)
+    @api.response(304, "Product not modified since the ETag in If-None-Match")
     @api.response(404, "Product not found")
-    @api.marshal_with(product_model)
     # @app.route("/products/<int:product_id>", methods=["GET"])
     def get(self, product_id):
         """
         Retrieve a single Product
 
-        This endpoint will return a Product based on it's id
+        This endpoint will return a Product based on it's id.
+        With fields=, only the listed fields are read and returned.
         """
         app.logger.info("Request for product with id: %s", product_id)
-        product = Product.find(product_id)
+        fields_list = parse_fields(fields_args.parse_args()["fields"])
+        if fields_list:
+            product = Product.find_fields(product_id, fields_list)
+        else:
+            product = Product.find(product_id)
         if not product:
             abort(
                 status.HTTP_404_NOT_FOUND,
                 f"Product with id '{product_id}' was not found.",
             )
 
-        app.logger.info("Returning product: %s", product.name)
-        return product.serialize(), status.HTTP_200_OK
+        etag = product_etag(product_id, product.version, fields_list)
+        headers = {"ETag": quote_etag(etag)}
+        if is_not_modified(etag):
+            app.logger.info("Product with id %s not modified", product_id)
+            return "", status.HTTP_304_NOT_MODIFIED, headers
+
+        app.logger.info("Returning product with id: %s", product_id)
+        data = product_view(product_serializer(fields_list)(product))
+        return data, status.HTTP_200_OK, headers
 
     # ------------------------------------------------------------------
     # UPDATE AN EXISTING PRODUCT
@@ -129,7 +391,7 @@ class ProductResource(Resource):
     @api.response(404, 'Product not found')
     @api.response(400, 'The posted Product data was not valid')
     @api.expect(product_model)
-    @api.marshal_with(product_model)
+    @api.response(200, "Success", product_model)
     def put(self, product_id):
         """
         Update a Product
@@ -139,7 +401,7 @@ class ProductResource(Resource):
         app.logger.info("Request to update product with id: %s", product_id)
         check_content_type("application/json")
 
-        product = Product.find(product_id)
+        product = Product.find(product_id, cached=False)
         if not product:
             abort(
                 status.HTTP_404_NOT_FOUND,
@@ -151,7 +413,7 @@ class ProductResource(Resource):
         product.id = product_id
         product.update()
         app.logger.info("Product with ID [%s] updated.", product.id)
-        return product.serialize(), status.HTTP_200_OK
+        return product_view(product.serialize()), status.HTTP_200_OK
 
     # ------------------------------------------------------------------
     # DELETE A PRODUCT
@@ -160,7 +422,7 @@ class ProductResource(Resource):
     def delete(self, product_id):
         """Delete a Product"""
         app.logger.info("Request to delete product with id: %s", product_id)
-        product = Product.find(product_id)
+        product = Product.find(product_id, cached=False)
         if product:
             product.delete()
 
@@ -181,88 +443,61 @@ class ProductCollection(Resource):
 
     @api.doc("list_products")
     @api.expect(product_args, validate=True)
-    @api.marshal_list_with(product_model)
-    def check_category(self, category):
-        products = Product.find_by_category(category)
-        results = [product.serialize() for product in products]
-        app.logger.info("Returning %d products", len(results))
-        return results
-
-    def check_price(self, price):
-        price = float(price)
-        if price < 0:
-            raise ValueError
-        products = Product.find_by_price(price)
-        results = [product.serialize() for product in products]
-        results.sort(key=lambda n: n["price"], reverse=True)
-        return results
-
-    def check_rating(self, rating_str):
-        rating = float(rating_str)
-        if rating < 1 or rating > 5:
-            raise ValueError
-        products = Product.find_by_rating(rating)
-        results = [
-            product.serialize() for product in products if product.rating is not None
-        ]
-        results.sort(key=lambda n: n["rating"], reverse=True)
-        return results
-
-    def check_name(self, name_str):
-        products = Product.find_by_name(name_str)
-        results = [product.serialize() for product in products]
-        return results
-
-    def eliminate_product(self, products_all, products):
-        result = []
-        tmpset = set()
-        for product in products:
-            tmpset.add(int(product["id"]))
-        for product in products_all:
-            if int(product["id"]) in tmpset:
-                result.append(product)
-        return result
-
-    def check_availability(self, available):
-        # if available != "True" or available != "true":
-        #    raise ValueError
-        products = Product.find_by_availability()
-        results = [product.serialize() for product in products]
-        return results
-
+    @api.response(304, "Products not modified since the ETag in If-None-Match")
     # @app.route("/products", methods=["GET"])
     def get(self):
+        """
+        List Products
+
+        This endpoint will return all Products matching the query string filters.
+        Every filter is compiled into a single database query.
+        With ids=, the Products with these ids are returned in the same order,
+        and the ids that were not found are listed in the X-Missing-Ids header.
+        With stream=true, or when asking for application/x-ndjson, the Products
+        are sent as a chunked response read from a server-side cursor.
+        """
         app.logger.info("Request for Product List")
-        products_all = Product.all()
-        results_all = [product.serialize() for product in products_all]
-        app.logger.info("Result_all : %s ", results_all)
         args = product_args.parse_args()
         app.logger.info("Got the Product Args : %s ", args)
         try:
-            if args['name']:
-                results = self.check_name(args["name"])
-                app.logger.info("Request for products with name : %s ", args["name"])
-                results_all = self.eliminate_product(results_all, results)
-            if args['category']:
-                results = self.check_category(args["category"])
-                app.logger.info("Request for products with category : %s ", args["category"])
-                app.logger.info("Length of results : %s ", results)
-                results_all = self.eliminate_product(results_all, results)
-                app.logger.info("Length of results_all : %s ", results_all)
-            if args['price'] is not None:
-                results = self.check_price(args["price"])
-                results_all = self.eliminate_product(results_all, results)
-            if args["rating"] is not None:
-                results = self.check_rating(args["rating"])
-                results_all = self.eliminate_product(results_all, results)
-            if args["available"] is not None:
-                results = self.check_availability(args["available"])
-                app.logger.info("Request for products with available : %s ", args["available"])
-                results_all = self.eliminate_product(results_all, results)
+            filters = build_filters(args)
+            limit = build_limit(args)
         except ValueError:
             return "", status.HTTP_406_NOT_ACCEPTABLE
-        app.logger.info("Returning %d products", len(results_all))
-        return results_all, status.HTTP_200_OK
+        fields_list = parse_fields(args["fields"])
+        if args["ids"] is not None:
+            ids = check_ids(parse_ids(args["ids"]))
+            results, missing = lookup_products(ids, fields_list, filters)
+            app.logger.info("Returning %d products by id", len(results))
+            headers = {"X-Missing-Ids": ",".join(str(item) for item in missing)}
+            return results, status.HTTP_200_OK, headers
+        order = parse_sort(args["sort"], searching="q" in filters)
+        after = decode_cursor(args["cursor"], order) if args["cursor"] else None
+        media_type = streamed_media_type(args)
+        page = dict(order=order, after=after, fields=fields_list, **filters)
+        if media_type and limit is None:
+            # no ETag, tagging the stream would read it all before sending it
+            app.logger.info("Streaming products as %s", media_type)
+            batch_size = app.config["STREAM_BATCH_SIZE"]
+            products = Product.read_rows(Product.select_rows(**page), batch_size)
+            serialize = row_serializer(fields_list)
+            return stream_response(
+                (serialize(product) for product in products), media_type, batch_size
+            )
+        # read before querying, so that a concurrent write makes the entry stale
+        key = listing_key(filters, order, after, limit, fields_list, media_type)
+        cached = Product.query_cache.get(key)
+        if cached is not None:
+            app.logger.info("Product list served from the query cache")
+            etag, results, link = cached
+        else:
+            if not media_type and app.config["LIST_RENDERER"] == "postgres":
+                results, count, link, digest = render_page_in_postgres(page, limit)
+            else:
+                results, count, link, digest = render_page(page, limit)
+            etag = collection_etag(digest, link, key)
+            Product.query_cache.set(key, (etag, results, link), count + 1)
+        return listing_response(etag, results, link, media_type)
 
     # ------------------------------------------------------------------
     # ADD A NEW PRODUCT
@@ -271,7 +506,7 @@ class ProductCollection(Resource):
     @api.doc("create_products")
     @api.response(400, "The posted data was not valid")
     @api.expect(create_model)
-    @api.marshal_with(product_model, code=201)
+    @api.response(201, "Product created", product_model)
     # @app.route("/products", methods=["POST"])
     def post(self):
         """
@@ -297,7 +532,7 @@ class ProductCollection(Resource):
         product.deserialize(data)
         app.logger.info("Here Deserialization done")
         product.create()
-        message = product.serialize()
+        message = product_view(product.serialize())
         location_url = api.url_for(
             ProductResource, product_id=product.id, _external=True
         )
@@ -305,6 +540,296 @@ class ProductCollection(Resource):
         app.logger.info("Product with ID [%s] created.", product.id)
         return message, status.HTTP_201_CREATED, {"Location": location_url}
 
+    # ------------------------------------------------------------------
+    # UPDATE THE PRODUCTS MATCHING A FILTER
+    # ------------------------------------------------------------------
+
+    @api.doc("update_products_by_filter")
+    @api.expect(bulk_args, bulk_update_model)
+    @api.response(200, "Success", bulk_result_model)
+    @api.response(400, "The changes were not valid, or no filter was given")
+    @api.response(406, "A filter was not acceptable")
+    def patch(self):
+        """
+        Update the Products matching a filter
+
+        This endpoint will apply the changes in the body to every Product
+        matching the query string filters, which are the same as the listing's,
+        with a single UPDATE. Prices scaled by price_factor are kept within
+        the accepted range. With dry_run=true, the Products are only counted.
+        """
+        app.logger.info("Request to update products by filter")
+        check_content_type("application/json")
+        args = bulk_args.parse_args()
+        try:
+            filters = build_filters(args)
+        except ValueError:
+            return "", status.HTTP_406_NOT_ACCEPTABLE
+        if args["ids"] is not None:
+            filters["ids"] = parse_ids(args["ids"])
+        check_bulk_filters(filters, args)
+        changes = api.payload
+        if not isinstance(changes, dict):
+            abort(status.HTTP_400_BAD_REQUEST, "The body must be an object")
+        changes = dict(changes)
+        price_factor = changes.pop("price_factor", None)
+        count = Product.update_many(
+            changes, price_factor, dry_run=bool(args["dry_run"]), **filters
+        )
+        app.logger.info("Bulk update affects %d products", count)
+        return {"count": count, "dry_run": bool(args["dry_run"])}, status.HTTP_200_OK
+
+    # ------------------------------------------------------------------
+    # DELETE THE PRODUCTS MATCHING A FILTER
+    # ------------------------------------------------------------------
+
+    @api.doc("delete_products_by_filter")
+    @api.expect(bulk_args)
+    @api.response(200, "Success", bulk_result_model)
+    @api.response(400, "No filter was given")
+    @api.response(406, "A filter was not acceptable")
+    def delete(self):
+        """
+        Delete the Products matching a filter
+
+        This endpoint will delete, with a single DELETE, the Products with
+        the given ids or matching the query string filters, which are the
+        same as the listing's. With dry_run=true, the Products are only counted.
+        """
+        app.logger.info("Request to delete products by filter")
+        args = bulk_args.parse_args()
+        try:
+            filters = build_filters(args)
+        except ValueError:
+            return "", status.HTTP_406_NOT_ACCEPTABLE
+        if args["ids"] is not None:
+            filters["ids"] = parse_ids(args["ids"])
+        check_bulk_filters(filters, args)
+        count = Product.delete_many(dry_run=bool(args["dry_run"]), **filters)
+        app.logger.info("Bulk delete affects %d products", count)
+        return {"count": count, "dry_run": bool(args["dry_run"])}, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /products/batch
+######################################################################
+@api.route("/products/batch")
+class ProductBatchResource(Resource):
+    """Creates many Products with a single request"""
+
+    @api.doc("create_products_batch")
+    @api.expect([create_model])
+    @api.response(201, "Every Product was created", batch_model)
+    @api.response(207, "Some Products were not created", batch_model)
+    @api.response(400, "The posted data was not an array")
+    @api.response(413, "Too many Products in the batch")
+    def post(self):
+        """
+        Creates many Products
+
+        This endpoint will validate every Product of the array in the body
+        like a single creation, and insert the valid ones in one transaction.
+        The results are reported per item, in the order of the array.
+        """
+        app.logger.info("Request to create products in bulk")
+        check_content_type("application/json")
+        items = api.payload
+        if not isinstance(items, list):
+            abort(status.HTTP_400_BAD_REQUEST, "The body must be an array of Products")
+        if len(items) > app.config["MAX_BATCH_SIZE"]:
+            abort(
+                status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                f"A batch holds at most {app.config['MAX_BATCH_SIZE']} Products",
+            )
+        results = []
+        for index, (product_id, error) in enumerate(Product.create_many(items)):
+            result = {"index": index, "id": product_id}
+            if error:
+                result["error"] = error
+            results.append(result)
+        failed = len([result for result in results if "error" in result])
+        report = {
+            "created": len(results) - failed,
+            "failed": failed,
+            "results": results,
+        }
+        app.logger.info("Created %d products in bulk", report["created"])
+        code = status.HTTP_207_MULTI_STATUS if failed else status.HTTP_201_CREATED
+        return report, code
+
+
+######################################################################
+#  PATH: /products/import
+######################################################################
+@api.route("/products/import")
+class ImportResource(Resource):
+    """Loads feeds of Products"""
+
+    @api.doc("import_products")
+    @api.response(200, "Success", import_model)
+    @api.response(415, "The feed is neither CSV nor NDJSON")
+    def post(self):
+        """
+        Import a feed of Products
+
+        This endpoint will read the CSV (text/csv) or NDJSON
+        (application/x-ndjson) body as it is received, and merge its valid
+        records in the catalog in a single transaction: new names are created,
+        known ones are updated. CSV feeds start with a line of field names.
+        """
+        app.logger.info("Request to import products as %s", request.mimetype)
+        if request.mimetype not in FEED_MEDIA_TYPES:
+            abort(
+                status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                "Content-Type must be one of " + ", ".join(FEED_MEDIA_TYPES),
+            )
+        lines = (line.decode("utf-8") for line in request.stream)
+        report = Product.import_records(
+            read_feed(lines, request.mimetype), app.config["IMPORT_CHUNK_SIZE"]
+        )
+        return report, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /products/export
+######################################################################
+@api.route("/products/export")
+class ExportResource(Resource):
+    """Dumps the whole catalog"""
+
+    @api.doc("export_products")
+    @api.expect(export_args)
+    @api.response(200, "The catalog, sent as a chunked response")
+    @api.response(406, "The format is not available")
+    def get(self):
+        """
+        Export every Product
+
+        This endpoint will stream the whole catalog as NDJSON, CSV or Parquet.
+        The rows are read from a server-side cursor and encoded a batch at a
+        time, and CSV and NDJSON are compressed as they are sent to clients
+        accepting gzip or brotli, so memory use does not grow with the catalog.
+        """
+        args = export_args.parse_args()
+        app.logger.info("Request to export products as %s", args["format"])
+        media_type = EXPORT_FORMATS[args["format"]]
+        # before the server-side cursor is opened
+        try:
+            check_export_format(media_type)
+        except ValueError as error:
+            abort(status.HTTP_406_NOT_ACCEPTABLE, str(error))
+        batch_size = app.config["STREAM_BATCH_SIZE"]
+        chunks = export_chunks(
+            Product.export_rows(batch_size), PRODUCT_FIELDS, media_type, batch_size
+        )
+        filename = f"products.{args['format']}"
+        return app.response_class(
+            stream_with_context(chunks),
+            mimetype=media_type,
+            headers={"Content-Disposition": f"attachment; filename={filename}"},
+        )
+
+
+######################################################################
+#  PATH: /products/lookup
+######################################################################
+@api.route("/products/lookup")
+class LookupResource(Resource):
+    """Fetches many Products by id with a single request"""
+
+    @api.doc("lookup_products")
+    @api.expect(lookup_model)
+    @api.response(200, "Success", lookup_result_model)
+    @api.response(400, "The ids were not valid")
+    @api.response(413, "Too many ids")
+    def post(self):
+        """
+        Look up Products by id
+
+        This endpoint will return the Products with the ids in the body, in
+        the same order, and the ids that were not found. It is meant for id
+        lists too long for the ids= query string of the listing.
+        """
+        app.logger.info("Request to look up products by id")
+        check_content_type("application/json")
+        data = api.payload
+        ids = data.get("ids") if isinstance(data, dict) else None
+        if not isinstance(ids, list) or not all(
+            isinstance(item, int) and not isinstance(item, bool) for item in ids
+        ):
+            abort(status.HTTP_400_BAD_REQUEST, "ids must be an array of integers")
+        fields_list = data.get("fields") or None
+        if fields_list is not None and (
+            not isinstance(fields_list, list)
+            or not all(isinstance(field, str) for field in fields_list)
+        ):
+            abort(status.HTTP_400_BAD_REQUEST, "fields must be an array of names")
+        results, missing = lookup_products(check_ids(ids), fields_list, {})
+        app.logger.info("Returning %d products by id", len(results))
+        return {"products": results, "missing": missing}, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /products/facets
+######################################################################
+@api.route("/products/facets")
+class FacetsResource(Resource):
+    """Counts of the Products used to draw the filter sidebars"""
+
+    @api.doc("product_facets")
+    @api.expect(filter_args, validate=True)
+    @api.response(406, "A filter was not acceptable")
+    def get(self):
+        """
+        Count Products by facet
+
+        This endpoint will return, for the Products matching the same filters
+        as the listing, the counts per category, per availability, per rating
+        bucket and per price bucket, computed by a single grouped query
+        """
+        app.logger.info("Request for Product facets")
+        args = filter_args.parse_args()
+        try:
+            filters = build_filters(args)
+        except ValueError:
+            return "", status.HTTP_406_NOT_ACCEPTABLE
+        facets = Product.facets(app.config["FACET_PRICE_BUCKETS"], **filters)
+        app.logger.info("Returning facets of %d products", facets["total"])
+        return facets, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /products/suggest
+######################################################################
+@api.route("/products/suggest")
+class SuggestResource(Resource):
+    """Typo tolerant autocomplete of Product names"""
+
+    @api.doc("suggest_products")
+    @api.expect(suggest_args)
+    @api.response(406, "The limit was not acceptable")
+    @api.response(200, "Success", [suggestion_model])
+    def get(self):
+        """
+        Suggest Product names
+
+        This endpoint will return the names starting with, or most alike,
+        the text typed so far, best match first
+        """
+        args = suggest_args.parse_args()
+        app.logger.info("Request for name suggestions for: %s", args["q"])
+        if args["limit"] < 1 or args["limit"] > app.config["MAX_SUGGESTIONS"]:
+            abort(
+                status.HTTP_406_NOT_ACCEPTABLE,
+                f"limit must be within [1,{app.config['MAX_SUGGESTIONS']}]",
+            )
+        suggestions = Product.suggest(args["q"], args["limit"])
+        results = [
+            {"id": product_id, "name": name, "score": score}
+            for product_id, name, score in suggestions
+        ]
+        return results, status.HTTP_200_OK
+
 
 ######################################################################
 #  PATH: /products/{id}/rating
@@ -320,7 +845,8 @@ class RatingResource(Resource):
     @api.response(404, 'Product not found')
     @api.response(406, 'JSON Not acceptable')
     @api.expect(product_model)
-    @api.marshal_with(product_model)
+    @api.response(200, "Success", product_model)
+    @api.response(202, "Rating accepted, applied at the next flush", product_model)
     def put(self, product_id):
         """
         Updates the rating of a product on the basis of feedback provided.
@@ -331,13 +857,6 @@ class RatingResource(Resource):
             "Request to update the rating of the product with id: %s", product_id
         )
         check_content_type("application/json")
-        product = Product.find(product_id)
-        if not product:
-            app.logger.info("Inside this condition")
-            abort(
-                status.HTTP_404_NOT_FOUND,
-                description=f"Product with id '{product_id}' was not found.",
-            )
         app.logger.info('Payload = %s ', api.payload)
         new_rating = api.payload
         if not isinstance(new_rating["rating"], int):
@@ -350,22 +869,26 @@ class RatingResource(Resource):
                 status.HTTP_406_NOT_ACCEPTABLE,
                 description="The ratings can be from [1,5]",
             )
-        if new_rating["rating"] is not None:
-            product.id = product_id
-            myJson = product.serialize()
-            product.deserialize(myJson)
-            product.id = product_id
-            if product.rating is None or product.no_of_users_rated == 0:
-                product.no_of_users_rated = 1
-                product.rating = float(new_rating["rating"])
-            else:
-                product.rating = float(
-                    product.rating * product.no_of_users_rated + new_rating["rating"]
-                ) / (product.no_of_users_rated + 1)
-                product.no_of_users_rated = product.no_of_users_rated + 1
-            product.update()
-            app.logger.info("Product with ID [%s] updated.", product.id)
-        return product.serialize(), status.HTTP_200_OK
+        if rating_buffer is not None:
+            # the cached copy is enough, votes for a deleted one are skipped
+            product = Product.find(product_id)
+            if not product:
+                abort(
+                    status.HTTP_404_NOT_FOUND,
+                    description=f"Product with id '{product_id}' was not found.",
+                )
+            rating_buffer.add(product.id, new_rating["rating"])
+            app.logger.info("Rating of Product with ID [%s] buffered.", product.id)
+            return product_view(product.serialize()), status.HTTP_202_ACCEPTED
+        # one atomic UPDATE, so that concurrent ratings are never lost
+        product = Product.rate(product_id, new_rating["rating"])
+        if not product:
+            abort(
+                status.HTTP_404_NOT_FOUND,
+                description=f"Product with id '{product_id}' was not found.",
+            )
+        app.logger.info("Product with ID [%s] rated.", product_id)
+        return product_view(product), status.HTTP_200_OK
 
 
 ######################################################################
@@ -382,7 +905,7 @@ class PriceResource(Resource):
     @api.response(404, 'Product not found')
     @api.response(406, 'JSON Format Not acceptable')
     @api.expect(product_model)
-    @api.marshal_with(product_model)
+    @api.response(200, "Success", product_model)
     def put(self, product_id):
         """
         Updates the price of a product on the basis of feedback provided.
@@ -393,7 +916,7 @@ class PriceResource(Resource):
             "Request to update the price of the product with id: %s", product_id
         )
         check_content_type("application/json")
-        product = Product.find(product_id)
+        product = Product.find(product_id, cached=False)
         if not product:
             app.logger.info("Product_id not found.")
             abort(
@@ -411,7 +934,7 @@ class PriceResource(Resource):
         product.price = new_price["price"]
         product.update()
         app.logger.info("Price of product with ID [%s] updated.", product.id)
-        return product.serialize(), status.HTTP_200_OK
+        return product_view(product.serialize()), status.HTTP_200_OK
 
 
 ######################################################################
@@ -428,7 +951,7 @@ class DescriptionResource(Resource):
     @api.response(404, 'Product not found')
     @api.response(406, 'JSON Format Not acceptable')
     @api.expect(product_model)
-    @api.marshal_with(product_model)
+    @api.response(200, "Success", product_model)
     def put(self, product_id):
         """
         Updates the description of a product on the basis of feedback provided.
@@ -439,7 +962,7 @@ class DescriptionResource(Resource):
             "Request to update the description of the product with id: %s", product_id
         )
         check_content_type("application/json")
-        product = Product.find(product_id)
+        product = Product.find(product_id, cached=False)
         if not product:
             app.logger.debug("Product_id not found.")
             abort(
@@ -460,7 +983,7 @@ class DescriptionResource(Resource):
         product.description = new_description["description"]
         product.update()
         app.logger.info("Description of product with ID [%s] updated.", product.id)
-        return product.serialize(), status.HTTP_200_OK
+        return product_view(product.serialize()), status.HTTP_200_OK
 
 
 ######################################################################
@@ -477,7 +1000,7 @@ class CategoryResource(Resource):
     @api.response(404, 'Product not found')
     @api.response(406, 'JSON Format Not acceptable')
     @api.expect(product_model)
-    @api.marshal_with(product_model)
+    @api.response(200, "Success", product_model)
     def put(self, product_id):
         """
         Updates the category of a product on the basis of feedback provided.
@@ -488,7 +1011,7 @@ class CategoryResource(Resource):
             "Request to update the category of the product with id: %s", product_id
         )
         check_content_type("application/json")
-        product = Product.find(product_id)
+        product = Product.find(product_id, cached=False)
         if not product:
             app.logger.info("Product_id not found.")
             abort(
@@ -506,7 +1029,31 @@ class CategoryResource(Resource):
         product.category = new_category["category"]
         product.update()
         app.logger.info("Category of product with ID [%s] updated.", product.id)
-        return product.serialize(), status.HTTP_200_OK
+        return product_view(product.serialize()), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /cache/stats
+######################################################################
+@api.route("/cache/stats")
+class CacheStatsResource(Resource):
+    """Counters of the in-process caches of this worker"""
+
+    @api.doc("cache_stats")
+    def get(self):
+        """
+        Returns the hit, miss and eviction counters of the caches
+
+        The counters are per worker process and are used to size the caches
+        """
+        app.logger.info("Request for cache stats")
+        stats = {
+            "products": Product.cache.stats(),
+            "queries": Product.query_cache.stats(),
+        }
+        if rating_buffer is not None:
+            stats["ratings"] = rating_buffer.stats()
+        return stats, status.HTTP_200_OK
 
 
 ######################################################################
@@ -515,9 +1062,379 @@ class CategoryResource(Resource):
 
 
 def init_db():
-    """Initializes the SQLAlchemy app"""
-    global app
+    """Initializes the SQLAlchemy app and the rating buffer"""
+    global app, rating_buffer
     Product.init_db(app)
+    if rating_buffer is None:
+        rating_buffer = init_rating_buffer(app, Product.rate_many)
+
+
+def build_filters(args) -> dict:
+    """Validates the parsed query string and returns the Product filters
+
+    Raises ValueError when a filter value is out of its accepted range
+    """
+    filters = {}
+    if args["name"]:
+        filters["name"] = args["name"]
+    if args["category"]:
+        filters["category"] = args["category"]
+    if args["available"] is not None:
+        filters["available"] = args["available"]
+    filters.update(build_thresholds(args))
+    filters.update(build_text_filters(args))
+    filters.update(build_range(args, "price", MIN_PRICE, MAX_PRICE))
+    filters.update(build_range(args, "rating", MIN_RATE, MAX_RATE))
+    return filters
+
+
+def build_thresholds(args) -> dict:
+    """Validates the highest price= and the lowest rating= of the Products
+
+    Raises ValueError when a threshold is out of its accepted range
+    """
+    thresholds = {}
+    if args["price"] is not None:
+        if args["price"] < 0:
+            raise ValueError("price cannot be negative")
+        thresholds["price"] = args["price"]
+    if args["rating"] is not None:
+        if args["rating"] < 1 or args["rating"] > 5:
+            raise ValueError("rating must be within [1,5]")
+        thresholds["rating"] = args["rating"]
+    return thresholds
+
+
+def build_text_filters(args) -> dict:
+    """Returns the full-text search and the name lookups of the query string"""
+    filters = {}
+    if args["q"] and args["q"].strip():
+        filters["q"] = args["q"].strip()
+    if args["name_prefix"]:
+        filters["name_prefix"] = args["name_prefix"]
+    if args["name_like"]:
+        filters["name_like"] = args["name_like"]
+    return filters
+
+
+def parse_ids(value: str) -> list:
+    """Returns the ids of a comma separated ids= argument, or aborts with 400"""
+    try:
+        return [int(item) for item in value.split(",") if item.strip()]
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, f"Invalid ids '{value}'")
+
+
+def check_ids(ids: list) -> list:
+    """Aborts with 413 when more ids are asked for than a batch can hold"""
+    if len(ids) > app.config["MAX_BATCH_SIZE"]:
+        abort(
+            status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            f"At most {app.config['MAX_BATCH_SIZE']} ids can be looked up at once",
+        )
+    return ids
+
+
+def lookup_products(ids: list, fields_list, filters: dict) -> tuple:
+    """Returns the Products with some ids, in their order, and the missing ids
+
+    Every id is resolved by the same query, whatever their number. Repeated
+    ids are only returned once.
+    """
+    ids = list(dict.fromkeys(ids))
+    statement = Product.select_rows(fields=fields_list, ids=ids, **filters)
+    found = {row.id: row for row in Product.read_rows(statement)}
+    serialize = row_serializer(fields_list)
+    results = [serialize(found[item]) for item in ids if item in found]
+    missing = [item for item in ids if item not in found]
+    return results, missing
+
+
+def check_bulk_filters(filters: dict, args):
+    """Aborts with 400 unless a bulk operation is given a filter, or all=true"""
+    if not filters and not args["all"]:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            "A filter is required, or all=true to change every Product",
+        )
+
+
+def build_range(args, field: str, lowest: float, highest: float) -> dict:
+    """Validates the <field>_min and <field>_max bounds of a range filter
+
+    Raises ValueError when a bound is outside of [lowest, highest] or when
+    the range is empty
+    """
+    bounds = {}
+    for bound in (f"{field}_min", f"{field}_max"):
+        if args[bound] is not None:
+            if args[bound] < lowest or args[bound] > highest:
+                raise ValueError(f"{bound} must be within [{lowest},{highest}]")
+            bounds[bound] = args[bound]
+    if len(bounds) == 2 and bounds[f"{field}_min"] > bounds[f"{field}_max"]:
+        raise ValueError(f"{field}_min cannot be greater than {field}_max")
+    return bounds
+
+
+def build_limit(args):
+    """Returns the page size requested by the query string
+
+    Pagination is only used when a limit or a cursor is given, in which case
+    the page size is capped at MAX_PAGE_SIZE. A cursor without a limit gets
+    CURSOR_PAGE_SIZE Products. Raises ValueError when the limit is not a
+    positive number.
+    """
+    if args["limit"] is None and not args["cursor"]:
+        return None
+    limit = args["limit"]
+    if limit is None:
+        limit = app.config["CURSOR_PAGE_SIZE"]
+    if limit < 1:
+        raise ValueError("limit must be a positive number")
+    return min(limit, app.config["MAX_PAGE_SIZE"])
+
+
+def parse_fields(value):
+    """Returns the list of field names of a fields= argument, or None"""
+    if not value:
+        return None
+    fields_list = []
+    for field in value.split(","):
+        field = field.strip()
+        if field and field not in fields_list:
+            fields_list.append(field)
+    return fields_list or None
+
+
+def parse_sort(value, searching: bool = False) -> list:
+    """Returns the (field, descending) keys of a sort= argument
+
+    The id is always added as the last key so that the order is total,
+    which keyset pagination relies on. Full-text searches can also be sorted
+    on their relevance with the rank key, and are by default.
+    Aborts with 400 on unknown fields.
+    """
+    if not value and searching:
+        return list(SEARCH_ORDER)
+    sort_fields = SORT_FIELDS + ["rank"] if searching else SORT_FIELDS
+    order = []
+    for key in (value or "").split(","):
+        key = key.strip()
+        descending = key.startswith("-")
+        key = key.lstrip("+-")
+        if not key:
+            continue
+        if key not in sort_fields:
+            abort(status.HTTP_400_BAD_REQUEST, f"Cannot sort Products on '{key}'")
+        if key not in [field for field, _ in order]:
+            order.append((key, descending))
+    if "id" not in [field for field, _ in order]:
+        order.extend(DEFAULT_ORDER)
+    return order
+
+
+def product_serializer(fields_list):
+    """Returns the function turning a Product, or a row of some of its fields,
+    into a dictionary with the requested fields"""
+    if not fields_list:
+        return Product.serialize
+    return lambda row: {field: getattr(row, field) for field in fields_list}
+
+
+def row_serializer(fields_list):
+    """Returns the function turning a row of Product.select_rows() into a
+    dictionary with the requested fields, which are its leading columns"""
+    names = fields_list or PRODUCT_FIELDS
+    return lambda row: dict(zip(names, row))
+
+
+def product_view(data: dict) -> dict:
+    """Returns a serialized Product as product_model describes it
+
+    This replaces marshalling, which walks the model fields of every row:
+    the id is the only field product_model formats differently.
+    """
+    if data.get("id") is not None:
+        data["id"] = str(data["id"])
+    return data
+
+
+def streamed_media_type(args):
+    """Returns the media type to stream the collection as, or None"""
+    media_type = request.accept_mimetypes.best_match(STREAM_MEDIA_TYPES)
+    if media_type == NDJSON_MEDIA_TYPE:
+        return NDJSON_MEDIA_TYPE
+    if args["stream"]:
+        return JSON_MEDIA_TYPE
+    return None
+
+
+def product_etag(product_id, version: int, fields_list) -> str:
+    """Returns the strong ETag of a Product at a given row version"""
+    etag = f"{product_id}-{version}"
+    if fields_list:
+        etag += "-" + hashlib.sha1(",".join(fields_list).encode("utf-8")).hexdigest()
+    return etag
+
+
+def render_page(page: dict, limit: int) -> tuple:
+    """Reads a page of Products and serializes its rows
+
+    Args:
+        page (dict): the order, cursor values, fields and filters of the page
+        limit (int): the page size, or None for every matching Product
+
+    Returns:
+        tuple: the Products, their number, the Link to the next page or None,
+            and the digest of their rows
+    """
+    link = None
+    # fetch one extra row to find out if there is a next page
+    statement = Product.select_rows(
+        limit=None if limit is None else limit + 1, versions=True, **page
+    )
+    products = Product.read_rows(statement).all()
+    if limit is not None and len(products) > limit:
+        products = products[:limit]
+        link = next_page_link(products[-1], page["order"], limit)
+    serialize = row_serializer(page["fields"])
+    results = [serialize(product) for product in products]
+    return results, len(results), link, rows_digest(products)
+
+
+def render_page_in_postgres(page: dict, limit: int) -> tuple:
+    """Has PostgreSQL render a page of Products as a JSON array
+
+    Returns the same tuple as render_page(), with the Products as JSON text
+    """
+    results, count, last, digest = Product.render_json(limit=limit, **page)
+    link = None
+    if last:
+        link = next_page_link(SimpleNamespace(**last), page["order"], limit)
+    return results, count, link, digest
+
+
+def listing_response(etag: str, results, link: str, media_type: str):
+    """Returns a rendered page of Products, or 304 if the client has it
+
+    Args:
+        etag (str): the ETag of the page
+        results: the Products, or their JSON text when rendered by PostgreSQL
+        link (str): the Link header to the next page, if any
+        media_type (str): the media type to send the page as, JSON if None
+    """
+    headers = {"ETag": quote_etag(etag)}
+    if is_not_modified(etag):
+        app.logger.info("Product list not modified")
+        return "", status.HTTP_304_NOT_MODIFIED, headers
+    if link:
+        headers["Link"] = link
+    if isinstance(results, str):
+        # already rendered as JSON by PostgreSQL
+        return app.response_class(results, mimetype=JSON_MEDIA_TYPE, headers=headers)
+    if media_type:
+        return stream_response(results, media_type, headers=headers)
+    app.logger.info("Returning %d products", len(results))
+    return results, status.HTTP_200_OK, headers
+
+
+def rows_digest(rows) -> str:
+    """Returns the md5 of the ids and row versions of a page of Products, as
+    Product.render_json() computes it"""
+    versions = ",".join(f"{row.id}:{row.row_version}" for row in rows)
+    return hashlib.md5(versions.encode("utf-8")).hexdigest()
+
+
+def collection_etag(digest: str, link: str, key: tuple) -> str:
+    """Returns the strong ETag of a page of Products
+
+    It is built from the rows of the page only, so that tagging a page does
+    not read the other matching Products. It changes when a Product of the
+    page does, or when a next page appears or goes away since the Link
+    header does, and differs between listings since the arguments of their
+    listing_key() change the response body.
+    """
+    # the catalog version is left out, it is not shared by the workers
+    tag = json.dumps([digest, link, key[1:]], default=str)
+    return hashlib.sha1(tag.encode("utf-8")).hexdigest()
+
+
+def listing_key(filters, order, after, limit, fields_list, media_type) -> tuple:
+    """Returns the key of a listing in Product.query_cache
+
+    It is built from the parsed arguments rather than the query string, so
+    that requests only differing in the order or spelling of their arguments
+    share an entry. The catalog version makes every write invalidate it.
+    """
+    return (
+        Product.catalog_version,
+        request.base_url,
+        media_type,
+        tuple(sorted(filters.items())),
+        tuple(order),
+        tuple(after) if after else None,
+        limit,
+        tuple(fields_list) if fields_list else None,
+    )
+
+
+def is_not_modified(etag: str) -> bool:
+    """Returns True if the If-None-Match header holds the current ETag"""
+    return request.if_none_match.contains_weak(etag)
+
+
+def sort_signature(order) -> str:
+    """Returns the sort= form of a list of (field, descending) keys"""
+    return ",".join(("-" if descending else "") + key for key, descending in order)
+
+
+def encode_cursor(product, order) -> str:
+    """Returns the opaque cursor pointing right after a Product"""
+    values = [getattr(product, key) for key, _ in order]
+    payload = json.dumps([sort_signature(order), values], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str, order) -> list:
+    """Returns the sort key values held by a cursor, or aborts with 400
+
+    A cursor is only valid for the sort order it was created with.
+    """
+    try:
+        signature, values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, TypeError, binascii.Error):
+        signature, values = None, None
+    if (
+        signature != sort_signature(order)
+        or not isinstance(values, list)
+        or len(values) != len(order)
+        or not all(
+            is_cursor_value(key, value) for (key, _), value in zip(order, values)
+        )
+    ):
+        abort(status.HTTP_400_BAD_REQUEST, f"Invalid cursor '{cursor}'")
+    return values
+
+
+def is_cursor_value(key: str, value) -> bool:
+    """Returns True if a value held by a cursor has the type of its sort key"""
+    if value is None:
+        return key not in ("id", "price")
+    if isinstance(value, bool):
+        return False
+    if key == "id":
+        return isinstance(value, int)
+    if key in ("name", "category"):
+        return isinstance(value, str)
+    return isinstance(value, (int, float))
+
+
+def next_page_link(product, order, limit) -> str:
+    """Returns the Link header pointing to the page after a Product"""
+    params = request.args.to_dict(flat=False)
+    params["cursor"] = [encode_cursor(product, order)]
+    params["limit"] = [str(limit)]
+    return f'<{request.base_url}?{urlencode(params, doseq=True)}>; rel="next"'
 
 
 def check_content_type(media_type):
@@ -0,0 +1,188 @@
+"""
+In-Process Caches
+
+This module contains the caches that keep hot data in the memory of each
+worker. A cache only needs get(), set(), delete(), clear() and stats(), so
+any object offering those can be plugged in instead of the ones below
+"""
+import heapq
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """A size bounded cache evicting the least recently used entries
+
+    Entries also expire ttl seconds after they were set, which bounds how
+    long a change made by another worker process can go unnoticed.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 30.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Returns the value cached for a key, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        """Caches a value, evicting the least recently used entries if full"""
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        """Removes the value cached for a key, if any"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Removes every cached value"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """Returns the counters used to size the cache"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+            }
+
+
+class SizedCache:
+    """A cache bounded by the total cost of its entries
+
+    Every entry is set with a cost, such as the number of rows of a query
+    result. When the total goes over capacity the most costly entries are
+    evicted first, the least recently used among equally costly ones, so that
+    one huge result does not push out many small hot ones. Entries costing
+    more than max_cost are never cached.
+
+    The keys are bucketed by cost, each bucket in least recently used order,
+    and a heap holds the costs of the buckets, so that finding the entry to
+    evict does not scan the whole cache while its lock is held.
+    """
+
+    def __init__(
+        self, capacity: int = 50000, ttl: float = 30.0, max_cost: int = None
+    ):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.max_cost = capacity // 4 if max_cost is None else max_cost
+        self._lock = threading.Lock()
+        self._entries = {}
+        # cost -> keys of that cost, least recently used first
+        self._buckets = {}
+        # negated costs of the buckets, may hold costs whose bucket is gone
+        self._costs = []
+        self.total_cost = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _add(self, key, value, cost: int):
+        """Adds an entry as the most recently used, the lock must be held"""
+        self._entries[key] = (value, cost, time.monotonic() + self.ttl)
+        bucket = self._buckets.get(cost)
+        if bucket is None:
+            bucket = self._buckets[cost] = OrderedDict()
+            if len(self._costs) >= 2 * len(self._buckets):
+                # drop the costs of the buckets that went away
+                self._costs = [-known for known in self._buckets]
+                heapq.heapify(self._costs)
+            else:
+                heapq.heappush(self._costs, -cost)
+        bucket[key] = None
+        self.total_cost += cost
+
+    def _remove(self, key):
+        """Removes an entry, the lock must be held"""
+        _, cost, _ = self._entries.pop(key)
+        bucket = self._buckets[cost]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[cost]
+        self.total_cost -= cost
+
+    def _most_costly(self):
+        """Returns the key to evict first, the lock must be held"""
+        while -self._costs[0] not in self._buckets:
+            heapq.heappop(self._costs)
+        return next(iter(self._buckets[-self._costs[0]]))
+
+    def get(self, key):
+        """Returns the value cached for a key, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[2] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._buckets[entry[1]].move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, cost: int = 1):
+        """Caches a value, evicting the most costly entries if over capacity"""
+        if cost > self.max_cost or cost > self.capacity:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._add(key, value, cost)
+            while self.total_cost > self.capacity:
+                self._remove(self._most_costly())
+                self.evictions += 1
+
+    def delete(self, key):
+        """Removes the value cached for a key, if any"""
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        """Removes every cached value"""
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+            self._costs = []
+            self.total_cost = 0
+
+    def stats(self) -> dict:
+        """Returns the counters used to size the cache"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._entries),
+                "cost": self.total_cost,
+                "capacity": self.capacity,
+                "ttl": self.ttl,
+            }
@@ -1,8 +1,19 @@
 """
 Flask CLI Command Extensions
 """
-from service import app
-from service.models import db
+import gzip
+import json
+import click
+from service import app, migrations
+from service.models import Product, PRODUCT_FIELDS, db
+from service.utils.feeds import (
+    FEED_MEDIA_TYPES,
+    EXPORT_FORMATS,
+    check_export_format,
+    export_chunks,
+    feed_media_type,
+    read_feed,
+)
 
 
 ######################################################################
@@ -16,5 +27,90 @@ def create_db():
     production.
     """
     db.drop_all()
-    db.create_all()
+    migrations.drop_version_table(db.engine)
+    migrations.upgrade(db.engine)
     db.session.commit()
+
+
+######################################################################
+# Command to apply the pending schema migrations
+# Usage: flask upgrade-db
+######################################################################
+@app.cli.command("upgrade-db")
+def upgrade_db():
+    """
+    Applies the schema migrations that the database is missing. Indexes are
+    built concurrently so this is safe to run on a live database.
+    """
+    versions = migrations.upgrade(db.engine)
+    app.logger.info("Applied migrations: %s", versions or "none")
+
+
+######################################################################
+# Command to load a feed of Products
+# Usage: flask import-products FEED.csv
+######################################################################
+@app.cli.command("import-products")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--format",
+    "file_format",
+    type=click.Choice(["csv", "ndjson"]),
+    help="Format of the feed, guessed from its extension by default",
+)
+def import_products(path, file_format):
+    """
+    Imports a CSV or NDJSON feed of Products. The feed is read and copied to
+    the database a chunk at a time, then merged in a single transaction.
+    """
+    media_type = feed_media_type(path, file_format)
+    if media_type not in FEED_MEDIA_TYPES:
+        raise click.BadParameter(
+            "use a .csv or .ndjson file, or --format", param_hint="path"
+        )
+    with open(path, encoding="utf-8", newline="") as feed:
+        report = Product.import_records(
+            read_feed(feed, media_type), app.config["IMPORT_CHUNK_SIZE"]
+        )
+    click.echo(json.dumps(report))
+
+
+######################################################################
+# Command to dump the catalog
+# Usage: flask export-products CATALOG.csv.gz
+######################################################################
+@app.cli.command("export-products")
+@click.argument("path", type=click.Path(dir_okay=False, writable=True))
+@click.option(
+    "--format",
+    "file_format",
+    type=click.Choice(list(EXPORT_FORMATS)),
+    help="Format of the dump, guessed from its extension by default",
+)
+def export_products(path, file_format):
+    """
+    Exports every Product as CSV, NDJSON or Parquet. The rows are read from a
+    server-side cursor and written a batch at a time, gzipped as they are
+    written when the file name ends with .gz, so memory use does not grow
+    with the catalog.
+    """
+    media_type = feed_media_type(path, file_format)
+    if media_type is None:
+        raise click.BadParameter(
+            "use a .csv, .ndjson or .parquet file, or --format", param_hint="path"
+        )
+    try:
+        check_export_format(media_type)
+    except ValueError as error:
+        raise click.UsageError(str(error))
+    batch_size = app.config["STREAM_BATCH_SIZE"]
+    chunks = export_chunks(
+        Product.export_rows(batch_size), PRODUCT_FIELDS, media_type, batch_size
+    )
+    opener = gzip.open if path.lower().endswith(".gz") else open
+    count = 0
+    with opener(path, "wb") as dump:
+        for chunk in chunks:
+            dump.write(chunk.encode("utf-8") if isinstance(chunk, str) else chunk)
+            count += 1
+    click.echo(f"Exported the catalog to {path} in {count} chunks")
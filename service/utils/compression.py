@@ -0,0 +1,185 @@
+"""
+Response Compression
+
+This module contains utility functions to compress the responses with the
+best encoding accepted by the client. Dynamic responses are compressed when
+sent, the static assets once at startup. Brotli is only offered when the
+brotli package is installed, gzip always is.
+"""
+import gzip
+import mimetypes
+import os
+import zlib
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+# media types worth compressing, anything else is sent as it is
+COMPRESSIBLE_TYPES = [
+    "application/json",
+    "application/x-ndjson",
+    "application/javascript",
+    "image/svg+xml",
+]
+
+# the best encoding first, as the client preferences are often all equal
+ENCODINGS = ["br", "gzip"] if brotli else ["gzip"]
+
+# precompressed static assets, {filename: {encoding: body}}
+static_assets = {}
+
+
+def is_compressible(mimetype) -> bool:
+    """Returns True if a media type is text that compresses well"""
+    if not mimetype:
+        return False
+    return mimetype.startswith("text/") or mimetype in COMPRESSIBLE_TYPES
+
+
+def accepted_encoding():
+    """Returns the best encoding accepted by the client, or None"""
+    accepted = request.accept_encodings
+    for encoding in ENCODINGS:
+        if accepted[encoding]:
+            return encoding
+    return None
+
+
+def compress(data: bytes, encoding: str, level: int) -> bytes:
+    """Compresses a body with an encoding
+
+    Args:
+        data (bytes): the body to compress
+        encoding (str): either "br" or "gzip"
+        level (int): the gzip level from 1 to 9, scaled to a brotli quality
+    """
+    if encoding == "br":
+        return brotli.compress(data, quality=_brotli_quality(level))
+    return gzip.compress(data, compresslevel=level)
+
+
+def _brotli_quality(level: int) -> int:
+    """Returns the brotli quality, from 0 to 11, of a gzip level"""
+    return min(11, round(level * 11 / 9))
+
+
+def compressed_chunks(chunks, encoding: str, level: int):
+    """Yields a compressed stream of chunks, flushing after each of them so
+    that the client keeps receiving rows while they are read"""
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=_brotli_quality(level))
+        compress_chunk, flush, finish = (
+            compressor.process,
+            compressor.flush,
+            compressor.finish,
+        )
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compress_chunk, finish = compressor.compress, compressor.flush
+
+        def flush():
+            return compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        yield compress_chunk(chunk) + flush()
+    yield finish()
+
+
+def precompress_static(folder: str, min_size: int) -> dict:
+    """Compresses every compressible static asset of at least min_size bytes
+
+    Returns:
+        dict: the compressed bodies by path relative to the folder and encoding
+    """
+    assets = {}
+    for root, _, files in os.walk(folder):
+        for name in files:
+            path = os.path.join(root, name)
+            mimetype = mimetypes.guess_type(name)[0]
+            if not is_compressible(mimetype) or os.path.getsize(path) < min_size:
+                continue
+            with open(path, "rb") as asset:
+                data = asset.read()
+            filename = os.path.relpath(path, folder).replace(os.sep, "/")
+            # startup only pays this once, so use the best ratio
+            assets[filename] = {
+                encoding: compress(data, encoding, 9) for encoding in ENCODINGS
+            }
+    return assets
+
+
+def _static_filename():
+    """Returns the static asset served by the current request, or None"""
+    if request.endpoint == "static":
+        return request.view_args.get("filename")
+    if request.endpoint == "index":
+        return "index.html"
+    return None
+
+
+def compress_response(response, min_size: int, level: int):
+    """Compresses a response with the best encoding accepted by the client
+
+    Responses that are partial, already encoded, not text, or smaller than
+    min_size bytes are sent as they are. A compressed body gets a weak ETag,
+    since it is no longer byte for byte the representation that was tagged.
+    """
+    if not is_compressible(response.mimetype):
+        return response
+    response.vary.add("Accept-Encoding")
+    if (
+        response.status_code not in (200, 201)
+        or "Content-Encoding" in response.headers
+        or "Content-Range" in response.headers
+    ):
+        return response
+    encoding = accepted_encoding()
+    if not encoding:
+        return response
+
+    filename = _static_filename()
+    if filename in static_assets:
+        response.response.close()
+        response.direct_passthrough = False
+        response.set_data(static_assets[filename][encoding])
+    elif response.is_streamed and not response.direct_passthrough:
+        response.response = compressed_chunks(response.response, encoding, level)
+        response.headers.pop("Content-Length", None)
+    elif not response.direct_passthrough:
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        response.set_data(compress(data, encoding, level))
+    else:
+        return response
+
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_compression(app):
+    """Precompresses the static assets and compresses every response
+
+    Reads the COMPRESSION_MIN_SIZE and COMPRESSION_LEVEL settings of the app
+    """
+    min_size = app.config.get("COMPRESSION_MIN_SIZE", 500)
+    static_assets.clear()
+    if app.static_folder:
+        static_assets.update(precompress_static(app.static_folder, min_size))
+    app.logger.info("Precompressed %d static assets", len(static_assets))
+
+    @app.after_request
+    def _compress(response):  # pylint: disable=unused-variable
+        return compress_response(
+            response,
+            app.config.get("COMPRESSION_MIN_SIZE", 500),
+            app.config.get("COMPRESSION_LEVEL", 6),
+        )
@@ -0,0 +1,207 @@
+"""
+Product Feeds
+
+This module contains utility functions to read the Products of a CSV or
+NDJSON feed one record at a time, and to write them as CSV, NDJSON or
+Parquet one batch at a time, so that feeds of any size are handled with
+bounded memory. Parquet needs the pyarrow package, which is only imported
+by the first Parquet export so that workers never exporting do not load it.
+"""
+import csv
+import importlib.util
+import io
+import json
+import os
+from service.utils.streaming import NDJSON_MEDIA_TYPE, batches, ndjson_chunks
+
+CSV_MEDIA_TYPE = "text/csv"
+PARQUET_MEDIA_TYPE = "application/vnd.apache.parquet"
+FEED_MEDIA_TYPES = [CSV_MEDIA_TYPE, NDJSON_MEDIA_TYPE]
+
+# formats the catalog can be exported as
+EXPORT_FORMATS = {
+    "csv": CSV_MEDIA_TYPE,
+    "ndjson": NDJSON_MEDIA_TYPE,
+    "parquet": PARQUET_MEDIA_TYPE,
+}
+
+# file extensions of the feeds read or written by the CLI commands
+FEED_EXTENSIONS = {f".{name}": value for name, value in EXPORT_FORMATS.items()}
+
+# column types of the Products written as Parquet
+PARQUET_TYPES = {
+    "id": "int64",
+    "name": "string",
+    "description": "string",
+    "category": "string",
+    "price": "float64",
+    "available": "bool",
+    "rating": "float64",
+    "no_of_users_rated": "int64",
+}
+
+TRUE_VALUES = ["true", "1", "yes"]
+FALSE_VALUES = ["false", "0", "no"]
+
+
+def _csv_value(field: str, value: str):
+    """Returns the typed value of a CSV cell
+
+    Values that cannot be converted are returned as they are, so that the
+    Product validation reports them.
+    """
+    if value is None or (value == "" and field in ("rating", "no_of_users_rated")):
+        return None
+    try:
+        if field in ("price", "rating"):
+            return float(value)
+        if field == "no_of_users_rated":
+            return int(value)
+    except ValueError:
+        return value
+    if field == "available" and value.lower() in TRUE_VALUES + FALSE_VALUES:
+        return value.lower() in TRUE_VALUES
+    return value
+
+
+def csv_records(lines):
+    """Yields the (line number, dictionary) of every row of a CSV feed
+
+    The first line holds the field names.
+    """
+    reader = csv.DictReader(lines)
+    for row in reader:
+        record = {field: _csv_value(field, value) for field, value in row.items()}
+        yield reader.line_num, record
+
+
+def ndjson_records(lines):
+    """Yields the (line number, dictionary) of every line of an NDJSON feed
+
+    Lines that are not valid JSON are yielded with None.
+    """
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line)
+        except ValueError:
+            yield number, None
+
+
+def read_feed(lines, media_type: str):
+    """Yields the (line number, dictionary) of every Product of a feed
+
+    Args:
+        lines: an iterable of the text lines of the feed
+        media_type (str): either CSV_MEDIA_TYPE or NDJSON_MEDIA_TYPE
+    """
+    if media_type == CSV_MEDIA_TYPE:
+        return csv_records(lines)
+    return ndjson_records(lines)
+
+
+def feed_media_type(path: str, file_format: str = None):
+    """Returns the media type of a feed file, from its format or extension
+
+    Returns None when neither tells the media type.
+    """
+    if file_format:
+        return EXPORT_FORMATS.get(file_format)
+    path = path.lower()
+    if path.endswith(".gz"):
+        path = path[:-3]
+    return FEED_EXTENSIONS.get(os.path.splitext(path)[1])
+
+
+def csv_chunks(rows, fields: list, batch_size: int = 500):
+    """Yields rows as CSV, after a line of field names, a batch at a time"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    for batch in batches(rows, batch_size):
+        writer.writerows(row[:len(fields)] for row in batch)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+class _ChunkSink(io.RawIOBase):
+    """A file collecting what is written to it until it is drained"""
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self) -> bytes:
+        """Returns and forgets what was written since the last call"""
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def parquet_chunks(rows, fields: list, batch_size: int = 500):
+    """Yields rows as a Parquet file, one row group per batch of rows"""
+    # pylint: disable=import-outside-toplevel
+    import pyarrow
+    from pyarrow import parquet
+
+    schema = pyarrow.schema(
+        [(field, pyarrow.type_for_alias(PARQUET_TYPES[field])) for field in fields]
+    )
+    sink = _ChunkSink()
+    writer = parquet.ParquetWriter(sink, schema, compression="zstd")
+    for batch in batches(rows, batch_size):
+        columns = list(zip(*batch))
+        writer.write_table(
+            pyarrow.table(
+                {field: list(columns[i]) for i, field in enumerate(fields)},
+                schema=schema,
+            )
+        )
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def parquet_available() -> bool:
+    """Returns whether pyarrow is installed, without importing it"""
+    return importlib.util.find_spec("pyarrow") is not None
+
+
+def check_export_format(media_type: str):
+    """Raises ValueError when a media type cannot be exported here"""
+    if media_type == PARQUET_MEDIA_TYPE and not parquet_available():
+        raise ValueError("Exporting as Parquet needs the pyarrow package")
+
+
+def export_chunks(rows, fields: list, media_type: str, batch_size: int = 500):
+    """Yields rows of Product fields encoded in a media type, a batch at a time
+
+    Args:
+        rows: an iterable of rows holding the fields first, ideally lazily read
+        fields (list): the names of the fields
+        media_type (str): one of the values of EXPORT_FORMATS
+        batch_size (int): the number of rows to encode in each chunk
+    """
+    check_export_format(media_type)
+    if media_type == CSV_MEDIA_TYPE:
+        return csv_chunks(rows, fields, batch_size)
+    if media_type == PARQUET_MEDIA_TYPE:
+        return parquet_chunks(rows, fields, batch_size)
+    records = (dict(zip(fields, row)) for row in rows)
+    return ndjson_chunks(records, batch_size)
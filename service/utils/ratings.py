@@ -0,0 +1,152 @@
+"""
+Buffered Ratings
+
+This module contains the write-behind buffer of the ratings. Votes are
+folded into a (sum, number) per Product in memory, and a background thread
+writes them all with one batched UPDATE every flush interval, or as soon as
+the buffer is full. Votes still buffered when a worker dies are lost, so the
+interval and size of the buffer bound what a crash can lose.
+"""
+import atexit
+import logging
+import threading
+
+logger = logging.getLogger("flask.app")
+
+
+class RatingBuffer:
+    """Per-Product deltas of the ratings, flushed in the background
+
+    flush_deltas is called with {product id: (sum, number)} and must write
+    them. When it fails the deltas are kept and retried at the next flush.
+    """
+
+    def __init__(self, flush_deltas, interval: float = 1.0, max_size: int = 10000):
+        self.flush_deltas = flush_deltas
+        self.interval = interval
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # only one flush at a time, so retried deltas are never written twice
+        self._flush_lock = threading.Lock()
+        self._deltas = {}
+        self._pending = 0
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.votes = 0
+        self.flushes = 0
+        self.failures = 0
+
+    def add(self, product_id: int, rating: float):
+        """Buffers a rating, waking the flusher when the buffer is full"""
+        with self._lock:
+            total, count = self._deltas.get(product_id, (0.0, 0))
+            self._deltas[product_id] = (total + rating, count + 1)
+            self._pending += 1
+            self.votes += 1
+            full = self._pending >= self.max_size
+        if full:
+            self._wake.set()
+
+    def _merge(self, deltas: dict, pending: int):
+        """Puts back deltas that could not be written, the lock must be held"""
+        for product_id, (total, count) in deltas.items():
+            current_total, current_count = self._deltas.get(product_id, (0.0, 0))
+            self._deltas[product_id] = (current_total + total, current_count + count)
+        self._pending += pending
+
+    def flush(self) -> int:
+        """Writes every buffered rating
+
+        Returns:
+            int: the number of votes written
+        """
+        with self._flush_lock:
+            with self._lock:
+                deltas, pending = self._deltas, self._pending
+                self._deltas, self._pending = {}, 0
+            if not deltas:
+                return 0
+            try:
+                self.flush_deltas(deltas)
+            except Exception as error:  # pylint: disable=broad-except
+                logger.error("Cannot flush %d ratings: %s", pending, error)
+                with self._lock:
+                    self._merge(deltas, pending)
+                    self.failures += 1
+                return 0
+            with self._lock:
+                self.flushes += 1
+            return pending
+
+    def _run(self):
+        """Flushes every interval, or sooner when woken, until stopped"""
+        while not self._stopped.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def start(self):
+        """Starts the background flusher"""
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="rating-flusher", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        """Stops the background flusher and drains the buffer, used on exit"""
+        if self._thread is not None:
+            self._stopped.set()
+            self._wake.set()
+            self._thread.join(self.interval + 10)
+            self._thread = None
+        flushed = self.flush()
+        if flushed:
+            logger.info("Drained %d buffered ratings", flushed)
+
+    def stats(self) -> dict:
+        """Returns the counters used to size the buffer"""
+        with self._lock:
+            return {
+                "votes": self.votes,
+                "pending": self._pending,
+                "products": len(self._deltas),
+                "flushes": self.flushes,
+                "failures": self.failures,
+                "interval": self.interval,
+                "max_size": self.max_size,
+            }
+
+
+def init_rating_buffer(app, write):
+    """Starts the rating buffer if the app enables it
+
+    Reads the RATING_BUFFER_ENABLED, RATING_FLUSH_INTERVAL and
+    RATING_BUFFER_MAX_SIZE settings of the app. The buffer is drained when
+    the process exits.
+
+    Args:
+        app: the Flask app, whose context the deltas are written in
+        write: the function writing {product id: (sum, number)}
+
+    Returns:
+        RatingBuffer: the started buffer, or None when it is disabled
+    """
+    if not app.config.get("RATING_BUFFER_ENABLED", False):
+        return None
+
+    def flush_deltas(deltas):
+        with app.app_context():
+            write(deltas)
+
+    buffer = RatingBuffer(
+        flush_deltas,
+        app.config.get("RATING_FLUSH_INTERVAL", 1.0),
+        app.config.get("RATING_BUFFER_MAX_SIZE", 10000),
+    )
+    buffer.start()
+    atexit.register(buffer.stop)
+    app.logger.info("Buffering ratings, flushed every %s seconds", buffer.interval)
+    return buffer
@@ -0,0 +1,57 @@
+"""
+Streaming Responses
+
+This module contains utility functions to send large collections as a
+chunked response, encoding rows as they are read instead of building the
+whole body in memory first
+"""
+from itertools import islice
+from flask import Response, stream_with_context
+from service.utils.encoders import dumps
+
+JSON_MEDIA_TYPE = "application/json"
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+STREAM_MEDIA_TYPES = [JSON_MEDIA_TYPE, NDJSON_MEDIA_TYPE]
+
+
+def batches(rows, batch_size: int):
+    """Splits an iterable of rows into lists of at most batch_size rows"""
+    iterator = iter(rows)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def json_array_chunks(rows, batch_size: int = 500):
+    """Yields a JSON array of rows one batch of elements at a time"""
+    separator = b"["
+    for batch in batches(rows, batch_size):
+        yield separator + b",".join(dumps(row) for row in batch)
+        separator = b","
+    yield b"[]\n" if separator == b"[" else b"]\n"
+
+
+def ndjson_chunks(rows, batch_size: int = 500):
+    """Yields rows as newline delimited JSON one batch of lines at a time"""
+    for batch in batches(rows, batch_size):
+        yield b"".join(dumps(row) + b"\n" for row in batch)
+
+
+def stream_response(rows, media_type: str, batch_size: int = 500, headers=None):
+    """Returns a chunked Response that encodes rows while they are read
+
+    Args:
+        rows: an iterable of JSON serializable rows, ideally lazily loaded
+        media_type (str): either JSON_MEDIA_TYPE or NDJSON_MEDIA_TYPE
+        batch_size (int): the number of rows to encode in each chunk
+        headers (dict): extra headers to send with the response
+    """
+    if media_type == NDJSON_MEDIA_TYPE:
+        chunks = ndjson_chunks(rows, batch_size)
+    else:
+        chunks = json_array_chunks(rows, batch_size)
+    return Response(
+        stream_with_context(chunks), mimetype=media_type, headers=headers
+    )
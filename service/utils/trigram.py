@@ -0,0 +1,100 @@
+"""
+Trigram Index
+
+This module contains an in-process trigram index of product names. It
+mirrors what the pg_trgm extension does, and is used for typo-tolerant
+lookups when the database cannot provide it (SQLite, or PostgreSQL without
+the extension installed)
+"""
+import re
+import threading
+import time
+from collections import defaultdict
+
+WORD = re.compile(r"\w+")
+
+
+def trigrams(text: str) -> set:
+    """Returns the trigrams of a text the way pg_trgm extracts them
+
+    Every word is lower cased and padded with two spaces in front and one
+    at the end, so "cat" gives "  c", " ca", "cat" and "at ".
+    """
+    grams = set()
+    for word in WORD.findall(text.lower()):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def similarity(first: str, second: str) -> float:
+    """Returns how alike two texts are, from 0 (nothing shared) to 1"""
+    first, second = trigrams(first), trigrams(second)
+    if not first or not second:
+        return 0.0
+    return len(first & second) / len(first | second)
+
+
+class TrigramIndex:
+    """An inverted index from trigrams to the names that contain them
+
+    The index is built from a loader returning (id, name) pairs. It is
+    rebuilt on the next lookup after invalidate() is called, or once it is
+    older than max_age seconds so that writes made by other processes show
+    up too.
+    """
+
+    def __init__(self, loader, max_age: float = 60.0, threshold: float = 0.3):
+        self.loader = loader
+        self.max_age = max_age
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._names = {}
+        self._postings = {}
+        self._built_at = None
+
+    def invalidate(self):
+        """Marks the index as stale so that it is rebuilt on next use"""
+        self._built_at = None
+
+    def _build(self):
+        """Loads every name and indexes its trigrams"""
+        names = {}
+        postings = defaultdict(set)
+        for product_id, name in self.loader():
+            if not name:
+                continue
+            names[product_id] = name
+            for gram in trigrams(name):
+                postings[gram].add(product_id)
+        self._names, self._postings = names, dict(postings)
+        self._built_at = time.monotonic()
+
+    def _current(self):
+        """Returns the names and postings, rebuilding them when stale"""
+        with self._lock:
+            built_at = self._built_at
+            if built_at is None or time.monotonic() - built_at > self.max_age:
+                self._build()
+            return self._names, self._postings
+
+    def search(self, text: str, limit: int = 10) -> list:
+        """Returns the (id, name, score) of the names most like a text
+
+        Names starting with the text always match, the others must be at
+        least `threshold` similar. Results are sorted by decreasing score.
+        """
+        names, postings = self._current()
+        grams = trigrams(text)
+        candidates = set()
+        for gram in grams:
+            candidates.update(postings.get(gram, ()))
+        prefix = text.lower()
+        matches = []
+        for product_id in candidates:
+            name = names[product_id]
+            score = similarity(text, name)
+            if score >= self.threshold or name.lower().startswith(prefix):
+                matches.append((product_id, name, score))
+        matches.sort(key=lambda match: (-match[2], match[1]))
+        return matches[:limit]
@@ -7,14 +7,20 @@ Test cases for Product Model
 # from itertools import product
 import os
 import logging
+import threading
 import unittest
+from unittest.mock import patch
 
 from random import randint
 
 # from sqlalchemy import true
 # from sqlalchemy import null
+from sqlalchemy import inspect, text
 from werkzeug.exceptions import NotFound
-from service.models import Product, DataValidationError, db
+from service import migrations
+from service.models import Product, DataValidationError, db, name_index, PRODUCT_FIELDS
+from service.utils.cache import LRUCache, SizedCache
+from service.utils.ratings import RatingBuffer
 from service import app
 from tests.factories import ProductFactory
 
@@ -49,6 +55,8 @@ class TestProduct(unittest.TestCase):
         """This runs before each test"""
         db.session.query(Product).delete()  # clean up the last tests
         db.session.commit()
+        Product.cache.clear()
+        Product.query_cache.clear()
 
     def tearDown(self):
         """This runs after each test"""
@@ -420,3 +428,317 @@ class TestProduct(unittest.TestCase):
         self.assertEqual(found.count(), count)
         for product in found:
             self.assertTrue(product.available)
+
+    def test_select_by_filters(self):
+        """It should Find Products matching several filters in one query"""
+        products = ProductFactory.create_batch(10)
+        for product in products:
+            product.create()
+        category = products[0].category
+        price = products[0].price
+        count = len(
+            [
+                product
+                for product in products
+                if product.category == category
+                and product.price <= price
+                and product.available is True
+            ]
+        )
+        statement = Product.select_rows(
+            category=category, price=price, available=True
+        )
+        found = list(Product.read_rows(statement))
+        self.assertEqual(len(found), count)
+        for row in found:
+            self.assertEqual(row.category, category)
+            self.assertGreaterEqual(price, row.price)
+            self.assertTrue(row.available)
+        self.assertEqual(len(list(Product.read_rows(Product.select_rows()))), 10)
+
+    def test_select_rows(self):
+        """It should read matching Products as plain rows"""
+        for _ in range(10):
+            product = ProductFactory()
+            product.create()
+        db.session.expunge_all()
+        statement = Product.select_rows(order=[("price", True), ("id", False)])
+        rows = Product.read_rows(statement).all()
+        self.assertEqual(len(rows), 10)
+        self.assertEqual(len(db.session.identity_map), 0)
+        prices = [row.price for row in rows]
+        self.assertEqual(prices, sorted(prices, reverse=True))
+        self.assertEqual(list(rows[0]._fields), PRODUCT_FIELDS)
+        statement = Product.select_rows(fields=["name"], available=True, limit=3)
+        rows = list(Product.read_rows(statement, batch_size=2))
+        self.assertLessEqual(len(rows), 3)
+        for row in rows:
+            self.assertEqual(row._fields, ("name", "id"))
+
+    def test_migrations_applied(self):
+        """It should apply every schema migration exactly once"""
+        applied = migrations.applied_versions(db.engine)
+        self.assertEqual(applied, {m.version for m in migrations.MIGRATIONS})
+        self.assertEqual(migrations.upgrade(db.engine), [])
+        indexes = {index["name"] for index in inspect(db.engine).get_indexes("product")}
+        self.assertIn("ix_product_category_rating_id", indexes)
+        self.assertIn("ix_product_available_id", indexes)
+        self.assertIn("ix_product_price_desc_id", indexes)
+        self.assertIn("ix_product_rating_asc_id", indexes)
+
+    def test_sorts_read_an_index(self):
+        """It should read every single key sort from an index without sorting"""
+        with db.engine.begin() as connection:
+            connection.execute(text("SET LOCAL enable_sort = off"))
+            connection.execute(text("SET LOCAL enable_seqscan = off"))
+            connection.execute(text("SET LOCAL enable_incremental_sort = off"))
+            for key in ["id", "price", "rating"]:
+                for descending in [False, True]:
+                    order = [(key, descending), ("id", False)]
+                    if key == "id":
+                        order = order[:1]
+                    statement = Product.select_rows(order=order, limit=10)
+                    sql = statement.compile(
+                        dialect=db.engine.dialect,
+                        compile_kwargs={"literal_binds": True},
+                    )
+                    plan = connection.execute(text(f"EXPLAIN {sql}")).scalars().all()
+                    sorts = [line for line in plan if "Sort  (" in line]
+                    self.assertEqual(sorts, [], f"{key} {descending}: {plan}")
+
+    def test_migration_lock(self):
+        """It should wait for the migration lock without blocking in PostgreSQL"""
+        done = []
+        engine = db.engine
+
+        def upgrade():
+            done.append(migrations.upgrade(engine))
+
+        waiter = threading.Thread(target=upgrade)
+        with db.engine.connect() as lock:
+            lock = lock.execution_options(isolation_level="AUTOCOMMIT")
+            key = {"key": migrations.LOCK_KEY}
+            lock.execute(text("SELECT pg_advisory_lock(:key)"), key)
+            waiter.start()
+            waiter.join(2 * migrations.LOCK_POLL_INTERVAL)
+            self.assertEqual(done, [])
+            blocked = lock.execute(
+                text(
+                    "SELECT count(*) FROM pg_stat_activity WHERE wait_event = "
+                    "'advisory' AND datname = current_database()"
+                )
+            ).scalar()
+            self.assertEqual(blocked, 0)
+            lock.execute(text("SELECT pg_advisory_unlock(:key)"), key)
+        waiter.join(5)
+        self.assertEqual(done, [[]])
+
+    def test_select_by_price_and_rating_range(self):
+        """It should Find Products within a price and a rating range"""
+        products = ProductFactory.create_batch(10)
+        for product in products:
+            product.create()
+        prices = sorted(product.price for product in products)
+        statement = Product.select_rows(price_min=prices[2], price_max=prices[6])
+        self.assertEqual(len(list(Product.read_rows(statement))), 5)
+        ratings = sorted(product.rating for product in products)
+        statement = Product.select_rows(rating_min=ratings[0], rating_max=ratings[4])
+        self.assertEqual(len(list(Product.read_rows(statement))), 5)
+        statement = Product.select_rows(
+            price_min=prices[2], price_max=prices[6], rating_min=ratings[5]
+        )
+        for row in Product.read_rows(statement):
+            self.assertTrue(prices[2] <= row.price <= prices[6])
+            self.assertGreaterEqual(row.rating, ratings[5])
+
+    def test_lru_cache(self):
+        """It should evict the least recently used and expired entries"""
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set(1, "one")
+        cache.set(2, "two")
+        self.assertEqual(cache.get(1), "one")
+        cache.set(3, "three")
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(3), "three")
+        cache.ttl = -1
+        cache.set(4, "four")
+        self.assertIsNone(cache.get(4))
+        self.assertEqual(
+            {key: cache.stats()[key] for key in ("hits", "misses", "evictions")},
+            {"hits": 2, "misses": 2, "evictions": 2},
+        )
+
+    def test_sized_cache(self):
+        """It should evict the most costly entries first"""
+        cache = SizedCache(capacity=10, ttl=60, max_cost=8)
+        cache.set("big", "big", 6)
+        cache.set("small", "small", 2)
+        cache.set("huge", "huge", 9)
+        self.assertIsNone(cache.get("huge"))
+        cache.set("other", "other", 3)
+        self.assertIsNone(cache.get("big"))
+        self.assertEqual(cache.get("small"), "small")
+        self.assertEqual(cache.get("other"), "other")
+        self.assertEqual(cache.stats()["cost"], 5)
+        self.assertEqual(cache.stats()["evictions"], 1)
+        # among equal costs the least recently used goes first
+        cache.set("third", "third", 3)
+        self.assertEqual(cache.get("other"), "other")
+        cache.set("fourth", "fourth", 3)
+        self.assertIsNone(cache.get("third"))
+        self.assertEqual(cache.get("other"), "other")
+        self.assertEqual(cache.get("small"), "small")
+        self.assertEqual(cache.stats()["cost"], 8)
+        cache.delete("other")
+        cache.clear()
+        cache.set("big", "big", 8)
+        cache.set("small", "small", 2)
+        self.assertEqual(cache.stats()["cost"], 10)
+
+    def test_catalog_changed(self):
+        """It should bump the catalog version on every write"""
+        version = Product.catalog_version
+        product = ProductFactory()
+        product.create()
+        self.assertEqual(Product.catalog_version, version + 1)
+        product.price = 42.0
+        product.update()
+        self.assertEqual(Product.catalog_version, version + 2)
+        product.delete()
+        self.assertEqual(Product.catalog_version, version + 3)
+
+    def test_name_index_invalidation(self):
+        """It should only rebuild the name index when names change"""
+        product = ProductFactory(rating=None, no_of_users_rated=0)
+        product.create()
+        with patch.object(name_index, "invalidate") as invalidate:
+            product.price = 42.0
+            product.update()
+            Product.rate(product.id, 4)
+            Product.update_many({"available": True})
+            invalidate.assert_not_called()
+            product = Product.find(product.id)
+            product.name = product.name + " renamed"
+            product.update()
+            invalidate.assert_called_once()
+            product.delete()
+            self.assertEqual(invalidate.call_count, 2)
+
+    def test_rate(self):
+        """It should add ratings to the sum and derive the average"""
+        product = ProductFactory(rating=None, no_of_users_rated=0)
+        product.create()
+        Product.rate(product.id, 2)
+        rated = Product.rate(product.id, 5)
+        self.assertAlmostEqual(rated["rating"], 3.5)
+        self.assertEqual(rated["no_of_users_rated"], 2)
+        found = Product.find(product.id)
+        db.session.refresh(found)
+        self.assertAlmostEqual(found.rating_sum, 7.0)
+        self.assertEqual(found.version, 3)
+        self.assertIsNone(Product.rate(product.id + 1, 3))
+        self.assertRaises(DataValidationError, Product.rate, product.id, 6)
+        self.assertRaises(DataValidationError, Product.rate, product.id, "5")
+        # no rating yet, whatever the number of users says
+        unrated = ProductFactory(rating=None, no_of_users_rated=5)
+        unrated.create()
+        rated = Product.rate(unrated.id, 5)
+        self.assertAlmostEqual(rated["rating"], 5.0)
+        self.assertEqual(rated["no_of_users_rated"], 1)
+
+    def test_rate_concurrently(self):
+        """It should not lose any of the ratings sent at the same time"""
+        product = ProductFactory(rating=None, no_of_users_rated=0)
+        product.create()
+
+        def rate_many():
+            with app.app_context():
+                for _ in range(10):
+                    Product.rate(product.id, 4)
+                db.session.remove()
+
+        threads = [threading.Thread(target=rate_many) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        found = db.session.get(Product, product.id)
+        db.session.refresh(found)
+        self.assertEqual(found.no_of_users_rated, 50)
+        self.assertAlmostEqual(found.rating, 4.0)
+        self.assertAlmostEqual(found.rating_sum, 200.0)
+
+    def test_fill_rating_sum(self):
+        """It should fill the rating sums of existing rows"""
+        product = ProductFactory(rating=4.5, no_of_users_rated=4)
+        product.create()
+        with db.engine.begin() as connection:
+            connection.execute(text("UPDATE product SET rating_sum = NULL"))
+            migrations.fill_rating_sum(connection)
+        db.session.refresh(product)
+        self.assertAlmostEqual(product.rating_sum, 18.0)
+        self.assertAlmostEqual(Product.rate(product.id, 2)["rating"], 4.0)
+
+    def test_rate_many(self):
+        """It should add batches of ratings with a single UPDATE"""
+        first = ProductFactory(rating=None, no_of_users_rated=0)
+        first.create()
+        second = ProductFactory(rating=2.0, no_of_users_rated=2)
+        second.create()
+        rated = Product.rate_many(
+            {first.id: (9.0, 2), second.id: (5.0, 1), second.id + 1: (1.0, 1)}
+        )
+        self.assertEqual(sorted(rated), sorted([first.id, second.id]))
+        db.session.refresh(first)
+        db.session.refresh(second)
+        self.assertAlmostEqual(first.rating, 4.5)
+        self.assertEqual(first.no_of_users_rated, 2)
+        self.assertAlmostEqual(second.rating, 3.0)
+        self.assertAlmostEqual(second.rating_sum, 9.0)
+        third = ProductFactory(rating=None, no_of_users_rated=3)
+        third.create()
+        Product.rate_many({third.id: (8.0, 2)})
+        db.session.refresh(third)
+        self.assertAlmostEqual(third.rating, 4.0)
+        self.assertEqual(third.no_of_users_rated, 2)
+        self.assertEqual(Product.rate_many({}), [])
+
+    def test_rating_buffer(self):
+        """It should fold ratings into deltas and keep them when a flush fails"""
+        written = []
+
+        def write(deltas):
+            if not written:
+                written.append(None)
+                raise OSError("database is down")
+            written.append(deltas)
+
+        buffer = RatingBuffer(write, interval=60, max_size=3)
+        buffer.add(1, 4)
+        buffer.add(1, 2)
+        self.assertEqual(buffer.flush(), 0)
+        self.assertEqual(buffer.stats()["failures"], 1)
+        buffer.add(2, 5)
+        self.assertEqual(buffer.stats()["pending"], 3)
+        self.assertEqual(buffer.flush(), 3)
+        self.assertEqual(written[-1], {1: (6.0, 2), 2: (5.0, 1)})
+        self.assertEqual(buffer.flush(), 0)
+
+    def test_rating_buffer_flusher(self):
+        """It should flush in the background once full, and drain when stopped"""
+        flushed = threading.Event()
+        written = []
+
+        def write(deltas):
+            written.append(deltas)
+            flushed.set()
+
+        buffer = RatingBuffer(write, interval=60, max_size=2)
+        buffer.start()
+        buffer.add(1, 3)
+        buffer.add(1, 5)
+        self.assertTrue(flushed.wait(5))
+        buffer.add(2, 1)
+        buffer.stop()
+        self.assertEqual(written, [{1: (8.0, 2)}, {2: (1.0, 1)}])
+        self.assertEqual(buffer.stats()["pending"], 0)
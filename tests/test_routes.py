@@ -6,18 +6,25 @@ Test cases can be run with the following:
   coverage report -m
 """
 import os
+import base64
+import gzip
+import json
 import logging
+import tempfile
 from unittest import TestCase
+from unittest.mock import patch
 
 # from unittest.mock import MagicMock, patch
 from service import app
-from service.models import Product
+from service.models import Product, PRODUCT_FIELDS
 from service.models import db, MIN_PRICE, MAX_PRICE, MAX_DESCRIPTION_LENGTH
+from service import routes
 from service.routes import init_db
-from service.utils import status
+from service.utils import feeds, status
+from service.utils.ratings import RatingBuffer
 from tests.factories import ProductFactory  # HTTP Status Codes
 
-from urllib.parse import quote_plus
+from urllib.parse import quote_plus, parse_qs, urlparse
 
 
 # DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///../db/test.db')
@@ -57,6 +64,8 @@ class TestYourResourceServer(TestCase):
         self.client = app.test_client()
         db.session.query(Product).delete()  # clean up the last tests
         db.session.commit()
+        Product.cache.clear()
+        Product.query_cache.clear()
 
     def tearDown(self):
         """This runs after each test"""
@@ -301,6 +310,30 @@ class TestYourResourceServer(TestCase):
         updated_product = response.get_json()
         self.assertAlmostEqual(updated_product["rating"], 3)
 
+    def test_buffered_rating(self):
+        """It should accept buffered ratings and apply them when flushed"""
+        product = self._create_products(1)[0]
+        buffer = RatingBuffer(Product.rate_many, interval=60, max_size=100)
+        routes.rating_buffer = buffer
+        try:
+            for rating in (2, 4, 5):
+                response = self.client.put(
+                    f"{BASE_URL}/{product.id}/rating", json={"rating": rating}
+                )
+                self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+            response = self.client.put(f"{BASE_URL}/0/rating", json={"rating": 3})
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+            response = self.client.get("/api/cache/stats")
+            self.assertEqual(response.get_json()["ratings"]["pending"], 3)
+            self.assertEqual(buffer.flush(), 3)
+        finally:
+            routes.rating_buffer = None
+        data = self.client.get(f"{BASE_URL}/{product.id}").get_json()
+        count = product.no_of_users_rated
+        self.assertEqual(data["no_of_users_rated"], count + 3)
+        expected = ((product.rating or 0) * count + 11) / (count + 3)
+        self.assertAlmostEqual(data["rating"], expected)
+
     def test_update_price(self):
         """It should update the price of a product"""
         # create a product to update
@@ -679,3 +712,809 @@ class TestYourResourceServer(TestCase):
         new_product["category"] = "a" * (MAX_CATEGORY_LENGTH + 1)
         response = self.client.put(f"{BASE_URL}/{id}/category", json=new_product)
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_query_list_by_unavailable(self):
+        """It should Query Products that are not available"""
+        products = self._create_products(10)
+        test_products = [product for product in products if product.available is False]
+        response = self.client.get(BASE_URL, query_string="available=false")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(len(data), len(test_products))
+        for product in data:
+            self.assertFalse(product["available"])
+
+    def test_get_product_list_by_page(self):
+        """It should page through the Products with a cursor"""
+        products = self._create_products(5)
+        ids = []
+        url = f"{BASE_URL}?limit=2"
+        pages = 0
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            data = response.get_json()
+            self.assertLessEqual(len(data), 2)
+            ids.extend(product["id"] for product in data)
+            pages += 1
+            link = response.headers.get("Link")
+            url = link[1:link.index(">")] if link else None
+            if pages == 1:
+                # a product created while paging shows up on the last page
+                products.extend(self._create_products(1))
+        self.assertEqual(pages, 3)
+        self.assertEqual(ids, sorted(int(product.id) for product in products))
+
+    def test_get_product_list_bad_cursor(self):
+        """It should not accept a bad cursor or limit"""
+        response = self.client.get(BASE_URL, query_string="cursor=not-a-cursor")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(BASE_URL, query_string="limit=0")
+        self.assertEqual(response.status_code, status.HTTP_406_NOT_ACCEPTABLE)
+        for values in ([], [1, 2], ["1"], [True], [None]):
+            payload = json.dumps(["id", values]).encode("utf-8")
+            cursor = base64.urlsafe_b64encode(payload).decode("ascii")
+            response = self.client.get(BASE_URL, query_string={"cursor": cursor})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        payload = json.dumps(["-price,id", [10, "x"]]).encode("utf-8")
+        cursor = base64.urlsafe_b64encode(payload).decode("ascii")
+        response = self.client.get(
+            BASE_URL, query_string={"cursor": cursor, "sort": "-price,id"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_stream_product_list(self):
+        """It should stream the Products as a JSON array"""
+        self._create_products(5)
+        response = self.client.get(BASE_URL, query_string="stream=true")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.mimetype, "application/json")
+        data = response.get_json()
+        self.assertEqual(len(data), 5)
+        response = self.client.get(
+            BASE_URL, query_string="stream=true&name=nothing-matches"
+        )
+        self.assertEqual(response.get_json(), [])
+
+    def test_stream_product_list_as_ndjson(self):
+        """It should stream the Products as newline delimited JSON"""
+        products = self._create_products(3)
+        response = self.client.get(
+            BASE_URL, headers={"Accept": "application/x-ndjson"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 3)
+        names = [json.loads(line)["name"] for line in lines]
+        self.assertEqual(names, [product.name for product in products])
+
+    def test_get_product_list_with_fields(self):
+        """It should return only the requested fields of the Products"""
+        products = self._create_products(3)
+        response = self.client.get(BASE_URL, query_string="fields=name,price&limit=2")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(len(data), 2)
+        self.assertEqual(data[0], {"name": products[0].name, "price": products[0].price})
+        self.assertIn("Link", response.headers)
+        response = self.client.get(BASE_URL, query_string="fields=name,secret")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_product_with_fields(self):
+        """It should return only the requested fields of a Product"""
+        test_product = self._create_products(1)[0]
+        response = self.client.get(
+            f"{BASE_URL}/{test_product.id}", query_string="fields=id,name"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(data, {"id": str(test_product.id), "name": test_product.name})
+        response = self.client.get(f"{BASE_URL}/0", query_string="fields=id,name")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_product_list_sorted(self):
+        """It should sort the Products in the database and page through them"""
+        products = self._create_products(6)
+        product = products[1].serialize()
+        product["rating"] = None
+        self.client.put(f"{BASE_URL}/{products[1].id}", json=product)
+        products[1].rating = None
+        expected = sorted(
+            products,
+            key=lambda p: (p.rating is None, -(p.rating or 0), int(p.id)),
+        )
+        names = []
+        url = f"{BASE_URL}?sort=-rating&limit=4"
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            names.extend(product["name"] for product in response.get_json())
+            link = response.headers.get("Link")
+            url = link[1:link.index(">")] if link else None
+        self.assertEqual(names, [product.name for product in expected])
+
+        response = self.client.get(BASE_URL, query_string="sort=price,name")
+        data = response.get_json()
+        self.assertEqual(
+            [product["name"] for product in data],
+            [product.name for product in sorted(products, key=lambda p: p.price)],
+        )
+
+    def test_get_product_list_bad_sort(self):
+        """It should not sort on unknown fields or reuse a cursor across sorts"""
+        self._create_products(3)
+        response = self.client.get(BASE_URL, query_string="sort=secret")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(BASE_URL, query_string="sort=price&limit=1")
+        link = response.headers.get("Link")
+        cursor = parse_qs(urlparse(link[1:link.index(">")]).query)["cursor"][0]
+        response = self.client.get(
+            BASE_URL, query_string={"sort": "name", "cursor": cursor}
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_query_list_by_price_and_rating_range(self):
+        """It should Query Products within a price and a rating range"""
+        products = self._create_products(10)
+        target_products = [
+            product
+            for product in products
+            if 20 <= product.price <= 60 and 2 <= product.rating <= 4.5
+        ]
+        response = self.client.get(
+            BASE_URL,
+            query_string="price_min=20&price_max=60&rating_min=2&rating_max=4.5",
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(len(data), len(target_products))
+
+    def test_query_list_by_bad_range(self):
+        """It should not Query Products with an invalid range"""
+        for query in (
+            f"price_min={MIN_PRICE - 1}",
+            f"price_max={MAX_PRICE + 1}",
+            "price_min=60&price_max=20",
+            "rating_max=6",
+            "rating_min=4&rating_max=3",
+        ):
+            response = self.client.get(BASE_URL, query_string=query)
+            self.assertEqual(response.status_code, status.HTTP_406_NOT_ACCEPTABLE)
+
+    def test_search_products(self):
+        """It should search the name and description ranked by relevance"""
+        for name, description in [
+            ("red shirt", "a shirt in red"),
+            ("blue jeans", "denim for every day"),
+            ("running shoes", "light shoes, a red sole"),
+            ("green hat", "wool"),
+        ]:
+            product = ProductFactory(name=name, description=description)
+            response = self.client.post(BASE_URL, json=product.serialize())
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = self.client.get(BASE_URL, query_string="q=red")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        names = [product["name"] for product in response.get_json()]
+        self.assertEqual(names, ["red shirt", "running shoes"])
+
+        # ranked results page like any other listing
+        response = self.client.get(BASE_URL, query_string="q=red&limit=1")
+        self.assertEqual(response.get_json()[0]["name"], "red shirt")
+        link = response.headers.get("Link")
+        response = self.client.get(link[1:link.index(">")])
+        self.assertEqual(
+            [product["name"] for product in response.get_json()], ["running shoes"]
+        )
+        response = self.client.get(BASE_URL, query_string="q=red&sort=name&fields=name")
+        self.assertEqual(
+            response.get_json(), [{"name": "red shirt"}, {"name": "running shoes"}]
+        )
+        response = self.client.get(BASE_URL, query_string="sort=rank")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_search_updated_product(self):
+        """It should find a Product by its updated description"""
+        test_product = self._create_products(1)[0]
+        response = self.client.put(
+            f"{BASE_URL}/{test_product.id}/description",
+            json={"description": "waterproof"},
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(BASE_URL, query_string="q=waterproof")
+        self.assertEqual(len(response.get_json()), 1)
+
+    def test_query_list_by_name_prefix_and_like(self):
+        """It should Query Products by the start or a part of their name"""
+        for name in ["Shirt_1", "Shirt 2", "T-Shirt", "Shoes"]:
+            response = self.client.post(BASE_URL, json=ProductFactory(name=name).serialize())
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = self.client.get(BASE_URL, query_string="name_prefix=Shirt")
+        names = [product["name"] for product in response.get_json()]
+        self.assertEqual(names, ["Shirt_1", "Shirt 2"])
+        response = self.client.get(BASE_URL, query_string="name_prefix=Shirt_")
+        names = [product["name"] for product in response.get_json()]
+        self.assertEqual(names, ["Shirt_1"])
+        response = self.client.get(BASE_URL, query_string="name_like=shirt")
+        names = [product["name"] for product in response.get_json()]
+        self.assertEqual(names, ["Shirt_1", "Shirt 2", "T-Shirt"])
+
+    def test_suggest_product_names(self):
+        """It should suggest the Product names closest to what was typed"""
+        for name in ["leather jacket", "leather belt", "denim jacket", "wool hat"]:
+            response = self.client.post(BASE_URL, json=ProductFactory(name=name).serialize())
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = self.client.get(f"{BASE_URL}/suggest", query_string="q=lether jaket")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(data[0]["name"], "leather jacket")
+        self.assertNotIn("wool hat", [product["name"] for product in data])
+        response = self.client.get(f"{BASE_URL}/suggest", query_string="q=lea&limit=1")
+        self.assertEqual(len(response.get_json()), 1)
+        self.assertTrue(response.get_json()[0]["name"].startswith("leather"))
+        response = self.client.get(f"{BASE_URL}/suggest", query_string="q=lea&limit=0")
+        self.assertEqual(response.status_code, status.HTTP_406_NOT_ACCEPTABLE)
+        response = self.client.get(f"{BASE_URL}/suggest")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_product_facets(self):
+        """It should count the filtered Products per facet"""
+        products = self._create_products(10)
+        category = products[0].category
+        matching = [product for product in products if product.category == category]
+        response = self.client.get(
+            f"{BASE_URL}/facets", query_string=f"category={quote_plus(category)}"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(data["total"], len(matching))
+        self.assertEqual(data["category"], [{"value": category, "count": len(matching)}])
+        self.assertEqual(
+            data["available"]["true"],
+            len([product for product in matching if product.available]),
+        )
+        self.assertEqual(sum(bucket["count"] for bucket in data["rating"]), len(matching))
+        self.assertEqual(sum(bucket["count"] for bucket in data["price"]), len(matching))
+        for bucket in data["price"]:
+            expected = [
+                product
+                for product in matching
+                if bucket["min"] <= product.price < bucket["max"]
+                or (bucket["max"] == MAX_PRICE and product.price == MAX_PRICE)
+            ]
+            self.assertEqual(bucket["count"], len(expected))
+        response = self.client.get(f"{BASE_URL}/facets", query_string="rating=9")
+        self.assertEqual(response.status_code, status.HTTP_406_NOT_ACCEPTABLE)
+
+    def test_get_product_not_modified(self):
+        """It should answer 304 when the ETag of a Product still matches"""
+        test_product = self._create_products(1)[0]
+        response = self.client.get(f"{BASE_URL}/{test_product.id}")
+        etag = response.headers.get("ETag")
+        self.assertIsNotNone(etag)
+        response = self.client.get(
+            f"{BASE_URL}/{test_product.id}", headers={"If-None-Match": etag}
+        )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(len(response.data), 0)
+        response = self.client.get(
+            f"{BASE_URL}/{test_product.id}",
+            query_string="fields=name",
+            headers={"If-None-Match": etag},
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.put(
+            f"{BASE_URL}/{test_product.id}/price", json={"price": MAX_PRICE}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(
+            f"{BASE_URL}/{test_product.id}", headers={"If-None-Match": etag}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.headers.get("ETag"), etag)
+
+    def test_get_product_list_not_modified(self):
+        """It should answer 304 when the ETag of a Product list still matches"""
+        products = self._create_products(3)
+        response = self.client.get(BASE_URL, query_string="sort=name")
+        etag = response.headers.get("ETag")
+        self.assertIsNotNone(etag)
+        response = self.client.get(
+            BASE_URL, query_string="sort=name", headers={"If-None-Match": etag}
+        )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        response = self.client.get(
+            BASE_URL, query_string="sort=price", headers={"If-None-Match": etag}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.put(
+            f"{BASE_URL}/{products[0].id}/description", json={"description": "new"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(
+            BASE_URL, query_string="sort=name", headers={"If-None-Match": etag}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response.headers.get("ETag")
+        self.client.delete(f"{BASE_URL}/{products[1].id}")
+        response = self.client.get(
+            BASE_URL, query_string="sort=name", headers={"If-None-Match": etag}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.get_json()), 2)
+
+    def test_get_product_list_page_etag(self):
+        """It should tag a page of Products from its rows only"""
+        products = self._create_products(4)
+        response = self.client.get(BASE_URL, query_string="limit=2")
+        etag = response.headers.get("ETag")
+        link = response.headers.get("Link")
+        # a change after the page leaves it as it was
+        self.client.put(
+            f"{BASE_URL}/{products[3].id}/description", json={"description": "new"}
+        )
+        response = self.client.get(
+            BASE_URL, query_string="limit=2", headers={"If-None-Match": etag}
+        )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        response = self.client.get(link[1:link.index(">")])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.headers.get("ETag"), etag)
+        response = self.client.get(BASE_URL, query_string="stream=true")
+        self.assertIsNone(response.headers.get("ETag"))
+
+    def test_get_product_list_next_page_etag(self):
+        """It should change the ETag of a page when a next page appears"""
+        try:
+            for renderer in ("python", "postgres"):
+                app.config["LIST_RENDERER"] = renderer
+                self._create_products(2)
+                response = self.client.get(BASE_URL, query_string="limit=2")
+                etag = response.headers.get("ETag")
+                self.assertIsNone(response.headers.get("Link"))
+                self._create_products(1)
+                response = self.client.get(
+                    BASE_URL, query_string="limit=2", headers={"If-None-Match": etag}
+                )
+                self.assertEqual(response.status_code, status.HTTP_200_OK, renderer)
+                self.assertIsNotNone(response.headers.get("Link"))
+                db.session.query(Product).delete()
+                db.session.commit()
+        finally:
+            app.config["LIST_RENDERER"] = "python"
+
+    def test_get_product_from_cache(self):
+        """It should serve repeated reads of a Product from the cache"""
+        test_product = self._create_products(1)[0]
+        stats = self.client.get("/api/cache/stats").get_json()["products"]
+        response = self.client.get(f"{BASE_URL}/{test_product.id}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(f"{BASE_URL}/{test_product.id}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()["name"], test_product.name)
+        new_stats = self.client.get("/api/cache/stats").get_json()["products"]
+        self.assertEqual(new_stats["misses"], stats["misses"] + 1)
+        self.assertEqual(new_stats["hits"], stats["hits"] + 1)
+
+        # writes through the API drop the cached copy
+        response = self.client.put(
+            f"{BASE_URL}/{test_product.id}/category", json={"category": "hats"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(f"{BASE_URL}/{test_product.id}")
+        self.assertEqual(response.get_json()["category"], "hats")
+        response = self.client.delete(f"{BASE_URL}/{test_product.id}")
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        response = self.client.get(f"{BASE_URL}/{test_product.id}")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_write_product_deleted_by_another_worker(self):
+        """It should not write a cached Product that was deleted elsewhere"""
+        test_product = self._create_products(1)[0]
+        response = self.client.get(f"{BASE_URL}/{test_product.id}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        # deleted without going through this worker, which keeps its copy
+        db.session.query(Product).filter(Product.id == int(test_product.id)).delete()
+        db.session.commit()
+        response = self.client.put(f"{BASE_URL}/{test_product.id}", json=data)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.put(
+            f"{BASE_URL}/{test_product.id}/price", json={"price": MIN_PRICE}
+        )
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.delete(f"{BASE_URL}/{test_product.id}")
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_list_products_from_cache(self):
+        """It should serve repeated listings from the query cache"""
+        self._create_products(3)
+        response = self.client.get(BASE_URL, query_string="available=true&sort=name")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        expected = response.get_json()
+        stats = self.client.get("/api/cache/stats").get_json()["queries"]
+        # the same arguments in another order share the cached entry
+        response = self.client.get(BASE_URL, query_string="sort=name&available=True")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json(), expected)
+        new_stats = self.client.get("/api/cache/stats").get_json()["queries"]
+        self.assertEqual(new_stats["hits"], stats["hits"] + 1)
+        etag = response.headers.get("ETag")
+        response = self.client.get(
+            BASE_URL,
+            query_string="available=true&sort=name",
+            headers={"If-None-Match": etag},
+        )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # writes through the API make the cached listings stale
+        self._create_products(1)
+        response = self.client.get(BASE_URL, query_string="sort=name")
+        self.assertEqual(len(response.get_json()), 4)
+
+    def test_compress_product_list(self):
+        """It should gzip large listings for clients accepting it"""
+        self._create_products(10)
+        response = self.client.get(BASE_URL, headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.headers.get("Content-Encoding"), "gzip")
+        self.assertIn("Accept-Encoding", response.headers.get("Vary"))
+        data = json.loads(gzip.decompress(response.data))
+        self.assertEqual(len(data), 10)
+        etag = response.headers.get("ETag")
+        self.assertTrue(etag.startswith("W/"))
+        response = self.client.get(
+            BASE_URL, headers={"Accept-Encoding": "gzip", "If-None-Match": etag}
+        )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # streamed listings are compressed chunk by chunk
+        response = self.client.get(
+            BASE_URL, query_string="stream=true", headers={"Accept-Encoding": "gzip"}
+        )
+        self.assertEqual(response.headers.get("Content-Encoding"), "gzip")
+        self.assertEqual(len(json.loads(gzip.decompress(response.data))), 10)
+
+    def test_no_compression(self):
+        """It should not compress small responses or for other clients"""
+        product = self._create_products(1)[0]
+        response = self.client.get(
+            f"{BASE_URL}/{product.id}", headers={"Accept-Encoding": "gzip"}
+        )
+        self.assertIsNone(response.headers.get("Content-Encoding"))
+        self.assertEqual(response.get_json()["name"], product.name)
+        self._create_products(9)
+        response = self.client.get(BASE_URL, headers={"Accept-Encoding": "identity"})
+        self.assertIsNone(response.headers.get("Content-Encoding"))
+        self.assertEqual(len(response.get_json()), 10)
+
+    def test_compress_static_assets(self):
+        """It should send the precompressed static assets"""
+        response = self.client.get(
+            "/static/js/rest_api.js", headers={"Accept-Encoding": "gzip"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.headers.get("Content-Encoding"), "gzip")
+        path = os.path.join(app.static_folder, "js", "rest_api.js")
+        with open(path, "rb") as asset:
+            self.assertEqual(gzip.decompress(response.data), asset.read())
+        self.assertEqual(int(response.headers["Content-Length"]), len(response.data))
+        response.close()
+
+    def test_swagger_models(self):
+        """It should still document the models of the responses"""
+        response = self.client.get("/api/swagger.json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        spec = response.get_json()
+        self.assertIn("ProductModel", spec["definitions"])
+        self.assertIn("Suggestion", spec["definitions"])
+        responses = spec["paths"]["/products/{product_id}"]["get"]["responses"]
+        self.assertEqual(
+            responses["200"]["schema"], {"$ref": "#/definitions/ProductModel"}
+        )
+
+    def test_list_products_rendered_by_postgres(self):
+        """It should build the same listings with PostgreSQL as with Python"""
+        products = self._create_products(7)
+        queries = [
+            "",
+            "sort=-price&fields=name,price",
+            "available=true&sort=name",
+            f"q={quote_plus(products[0].name)}",
+            "limit=3&sort=-rating",
+        ]
+        try:
+            for query_string in queries:
+                results = {}
+                for renderer in ("python", "postgres"):
+                    app.config["LIST_RENDERER"] = renderer
+                    Product.query_cache.clear()
+                    pages = []
+                    url = f"{BASE_URL}?{query_string}"
+                    while url:
+                        response = self.client.get(url)
+                        self.assertEqual(response.status_code, status.HTTP_200_OK)
+                        self.assertEqual(response.mimetype, CONTENT_TYPE_JSON)
+                        pages.append(
+                            (response.get_json(), response.headers.get("ETag"))
+                        )
+                        link = response.headers.get("Link")
+                        url = link[1:link.index(">")] if link else None
+                    results[renderer] = pages
+                self.assertEqual(results["postgres"], results["python"], query_string)
+        finally:
+            app.config["LIST_RENDERER"] = "python"
+
+    def test_create_products_batch(self):
+        """It should create many Products with a single request"""
+        existing = self._create_products(1)[0]
+        items = [ProductFactory().serialize() for _ in range(4)]
+        items[1]["price"] = MAX_PRICE + 1
+        items[2]["name"] = existing.name
+        items.append(dict(items[0]))
+        response = self.client.post(f"{BASE_URL}/batch", json=items)
+        self.assertEqual(response.status_code, 207)
+        report = response.get_json()
+        self.assertEqual(report["created"], 2)
+        self.assertEqual(report["failed"], 3)
+        results = report["results"]
+        self.assertEqual([result["index"] for result in results], [0, 1, 2, 3, 4])
+        self.assertIn("price", results[1]["error"])
+        self.assertIn("already exists", results[2]["error"])
+        self.assertIn("repeated", results[4]["error"])
+        for position in (0, 3):
+            product = Product.find(results[position]["id"])
+            self.assertEqual(product.name, items[position]["name"])
+            self.assertEqual(product.price, items[position]["price"])
+
+        items = [ProductFactory().serialize() for _ in range(3)]
+        response = self.client.post(f"{BASE_URL}/batch", json=items)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        ids = [result["id"] for result in response.get_json()["results"]]
+        self.assertEqual(ids, sorted(ids))
+        response = self.client.get(BASE_URL)
+        self.assertEqual(len(response.get_json()), 6)
+
+    def test_create_products_batch_bad_request(self):
+        """It should not create a batch that is not an array"""
+        response = self.client.post(f"{BASE_URL}/batch", json={"name": "hat"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(f"{BASE_URL}/batch", data="[]")
+        self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def test_update_products_by_filter(self):
+        """It should update every Product matching a filter at once"""
+        products = self._create_products(6)
+        category = products[0].category
+        matching = [product for product in products if product.category == category]
+        response = self.client.patch(
+            BASE_URL,
+            query_string={"category": category, "dry_run": "true"},
+            json={"available": False},
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json(), {"count": len(matching), "dry_run": True})
+        response = self.client.get(BASE_URL, query_string={"category": category})
+        self.assertEqual(response.get_json()[0]["available"], products[0].available)
+
+        response = self.client.patch(
+            BASE_URL, query_string={"category": category}, json={"available": False}
+        )
+        self.assertEqual(response.get_json(), {"count": len(matching), "dry_run": False})
+        response = self.client.get(BASE_URL, query_string={"category": category})
+        self.assertFalse(any(product["available"] for product in response.get_json()))
+
+        # scaled prices are clamped to the accepted range
+        response = self.client.patch(
+            BASE_URL, query_string="all=true", json={"price_factor": 100}
+        )
+        self.assertEqual(response.get_json()["count"], 6)
+        response = self.client.get(BASE_URL)
+        self.assertEqual({product["price"] for product in response.get_json()}, {MAX_PRICE})
+        response = self.client.patch(
+            BASE_URL, query_string="all=true", json={"price_factor": 0.01}
+        )
+        response = self.client.get(BASE_URL)
+        self.assertEqual({product["price"] for product in response.get_json()}, {MIN_PRICE})
+
+    def test_update_products_by_filter_bad_request(self):
+        """It should not update Products without a filter or with bad changes"""
+        self._create_products(2)
+        response = self.client.patch(BASE_URL, json={"available": False})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        for changes in (
+            {"price": MAX_PRICE + 1},
+            {"price_factor": -1},
+            {"price": MIN_PRICE, "price_factor": 2},
+            {"name": "same name"},
+            {},
+        ):
+            response = self.client.patch(
+                BASE_URL, query_string="all=true", json=changes
+            )
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, changes)
+        response = self.client.patch(
+            BASE_URL, query_string="rating=9", json={"available": False}
+        )
+        self.assertEqual(response.status_code, status.HTTP_406_NOT_ACCEPTABLE)
+
+    def test_delete_products_by_filter(self):
+        """It should delete the Products matching a filter at once"""
+        products = self._create_products(6)
+        ids = [product.id for product in products]
+        response = self.client.delete(
+            BASE_URL, query_string=f"ids={ids[0]},{ids[1]}&dry_run=true"
+        )
+        self.assertEqual(response.get_json(), {"count": 2, "dry_run": True})
+        response = self.client.delete(BASE_URL, query_string=f"ids={ids[0]},{ids[1]}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json(), {"count": 2, "dry_run": False})
+        response = self.client.get(f"{BASE_URL}/{ids[0]}")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        category = products[2].category
+        remaining = [
+            product for product in products[2:] if product.category == category
+        ]
+        response = self.client.delete(BASE_URL, query_string={"category": category})
+        self.assertEqual(response.get_json()["count"], len(remaining))
+        response = self.client.delete(BASE_URL, query_string="all=true")
+        self.assertEqual(response.get_json()["count"], 4 - len(remaining))
+        self.assertEqual(self.client.get(BASE_URL).get_json(), [])
+
+    def test_delete_products_bad_request(self):
+        """It should not delete Products without a filter"""
+        self._create_products(1)
+        response = self.client.delete(BASE_URL)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.delete(BASE_URL, query_string="ids=1,two")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(len(self.client.get(BASE_URL).get_json()), 1)
+
+    def test_get_products_by_ids(self):
+        """It should return many Products by id in the requested order"""
+        products = self._create_products(4)
+        ids = [int(products[2].id), int(products[0].id), 0, int(products[3].id)]
+        response = self.client.get(
+            BASE_URL, query_string={"ids": ",".join(str(item) for item in ids)}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual([product["id"] for product in data], [ids[0], ids[1], ids[3]])
+        self.assertEqual(data[0]["name"], products[2].name)
+        self.assertEqual(response.headers.get("X-Missing-Ids"), "0")
+
+        response = self.client.get(
+            BASE_URL, query_string={"ids": f"{ids[1]},{ids[0]}", "fields": "name"}
+        )
+        names = [{"name": products[0].name}, {"name": products[2].name}]
+        self.assertEqual(response.get_json(), names)
+        self.assertEqual(response.headers.get("X-Missing-Ids"), "")
+        response = self.client.get(BASE_URL, query_string="ids=1,x")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_lookup_products(self):
+        """It should look up many Products by id posted in the body"""
+        products = self._create_products(3)
+        ids = [int(products[1].id), 0, int(products[0].id), int(products[1].id)]
+        response = self.client.post(f"{BASE_URL}/lookup", json={"ids": ids})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(
+            [product["id"] for product in data["products"]], [ids[0], ids[2]]
+        )
+        self.assertEqual(data["missing"], [0])
+        body = {"ids": [int(products[2].id)], "fields": ["price"]}
+        response = self.client.post(f"{BASE_URL}/lookup", json=body)
+        self.assertEqual(
+            response.get_json()["products"], [{"price": products[2].price}]
+        )
+        for body in (
+            {"ids": "1,2"},
+            {"ids": [1, "2"]},
+            [1, 2],
+            {"ids": [1], "fields": [1]},
+        ):
+            response = self.client.post(f"{BASE_URL}/lookup", json=body)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, body)
+
+    def test_import_products(self):
+        """It should merge CSV and NDJSON feeds into the catalog"""
+        existing = self._create_products(1)[0]
+        feed = (
+            "name,description,category,price,available,rating\n"
+            f"{existing.name},new text,hats,{MIN_PRICE},false,\n"
+            'scarf,"warm, soft",scarves,20.5,true,4\n'
+            "gloves,pair,gloves,1000,true,\n"
+            "scarf,warmer,scarves,21,true,\n"
+            "belt,,belts,15,yes,\n"
+        )
+        response = self.client.post(
+            f"{BASE_URL}/import", data=feed, content_type="text/csv"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        report = response.get_json()
+        self.assertEqual(report["inserted"], 2)
+        self.assertEqual(report["updated"], 1)
+        self.assertEqual(report["failed"], 1)
+        self.assertEqual(report["errors"][0]["line"], 4)
+        product = Product.find(existing.id)
+        self.assertEqual(product.category, "hats")
+        self.assertEqual(product.price, MIN_PRICE)
+        self.assertEqual(product.rating, existing.rating)
+        # the last record of a name wins
+        scarf = Product.find_by_name("scarf").first()
+        self.assertEqual((scarf.description, scarf.price), ("warmer", 21.0))
+        self.assertEqual(Product.find_by_name("belt").first().description, "")
+
+        lines = [ProductFactory().serialize() for _ in range(3)]
+        feed = "\n".join(json.dumps(line) for line in lines) + "\n{oops\n"
+        response = self.client.post(
+            f"{BASE_URL}/import", data=feed, content_type="application/x-ndjson"
+        )
+        report = response.get_json()
+        self.assertEqual((report["inserted"], report["failed"]), (3, 1))
+        self.assertEqual(len(self.client.get(BASE_URL).get_json()), 6)
+        response = self.client.post(f"{BASE_URL}/import", json=lines)
+        self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def test_import_products_command(self):
+        """It should import a feed file from the command line"""
+        product = ProductFactory()
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "feed.ndjson")
+            with open(path, "w", encoding="utf-8") as feed:
+                feed.write(json.dumps(product.serialize()) + "\n")
+            runner = app.test_cli_runner()
+            result = runner.invoke(args=["import-products", path])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(json.loads(result.output)["inserted"], 1)
+        self.assertEqual(Product.find_by_name(product.name).count(), 1)
+
+    def test_export_products(self):
+        """It should stream the whole catalog as NDJSON or CSV"""
+        products = self._create_products(5)
+        response = self.client.get(f"{BASE_URL}/export")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        lines = [json.loads(line) for line in response.data.splitlines()]
+        self.assertEqual([line["name"] for line in lines], [p.name for p in products])
+
+        response = self.client.get(
+            f"{BASE_URL}/export",
+            query_string="format=csv",
+            headers={"Accept-Encoding": "gzip"},
+        )
+        self.assertEqual(response.mimetype, "text/csv")
+        self.assertEqual(response.headers.get("Content-Encoding"), "gzip")
+        rows = gzip.decompress(response.data).decode("utf-8").splitlines()
+        self.assertEqual(rows[0], ",".join(PRODUCT_FIELDS))
+        self.assertEqual(len(rows), 6)
+        response = self.client.get(f"{BASE_URL}/export", query_string="format=parquet")
+        if not feeds.parquet_available():
+            self.assertEqual(response.status_code, status.HTTP_406_NOT_ACCEPTABLE)
+        else:
+            self.assertEqual(response.data[:4], b"PAR1")
+        response = self.client.get(f"{BASE_URL}/export", query_string="format=xml")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        # without pyarrow, Parquet is refused before the catalog is read
+        with patch.object(feeds, "parquet_available", return_value=False), patch.object(
+            Product, "export_rows"
+        ) as export_rows:
+            response = self.client.get(
+                f"{BASE_URL}/export", query_string="format=parquet"
+            )
+            self.assertEqual(response.status_code, status.HTTP_406_NOT_ACCEPTABLE)
+            export_rows.assert_not_called()
+
+    def test_export_products_command(self):
+        """It should export the catalog to a gzipped file from the command line"""
+        self._create_products(3)
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "catalog.ndjson.gz")
+            result = app.test_cli_runner().invoke(args=["export-products", path])
+            self.assertEqual(result.exit_code, 0, result.output)
+            with gzip.open(path, "rt", encoding="utf-8") as dump:
+                lines = [json.loads(line) for line in dump]
+        self.assertEqual(len(lines), 3)